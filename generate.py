@@ -1,12 +1,21 @@
 from pickle import FALSE
-from typing import List, Dict, Tuple, Any, Union, Callable
+from typing import List, Dict, Tuple, Any, Union, Callable, NamedTuple, Optional, Iterable
 import contextlib
+import copy
+import queue
+import threading
 import argparse
 import json
-import re
+try:
+    import orjson  # faster parsing of jsonl lines
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 import math
 import logging
 import sys
+import os
+import shutil
 from tqdm import tqdm
 import torch
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
@@ -17,6 +26,11 @@ from memtrans import MemTransWrapper
 logger = logging.getLogger(__name__)
 logger.setLevel(20)
 
+class Example(NamedTuple):
+    source: str
+    target: str
+    decoder_prefix: Optional[str] = None  # None when the data has no decoder prefix
+
 class GenerationWrapper(object):
     def __init__(
         self, 
@@ -26,7 +40,13 @@ class GenerationWrapper(object):
         self.model = model
         self.model.eval()
         self.tokenizer = tokenizer
-        self._all_tokens = list(self.tokenizer.get_vocab().values())
+        # built once and returned by reference for every unconstrained decoding step
+        # a tensor on the model device indexes the logits mask without any conversion or copy
+        vocab_ids = sorted(set(self.tokenizer.get_vocab().values()))
+        if vocab_ids == list(range(len(vocab_ids))):
+            self._all_tokens: torch.LongTensor = torch.arange(len(vocab_ids), device=self.device)
+        else:
+            self._all_tokens: torch.LongTensor = torch.tensor(vocab_ids, dtype=torch.long, device=self.device)
 
         self.source_prefix: str = args.source_prefix
         self.source_suffix: str = args.source_suffix
@@ -39,8 +59,14 @@ class GenerationWrapper(object):
         self.target_as_prefix_len: int = args.target_as_prefix_len  # number of tokens in the target used as prefix
 
         self.batch_size: int = args.batch_size
+        self.num_workers: int = args.num_workers  # number of batches prepared ahead on a background thread
+        self.amp_dtype: torch.dtype = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[args.dtype]
         self.gen_args: Dict[str, Any] = {
             'max_length': args.max_gen_len,
+            'num_beams': args.num_beams,
+            'early_stopping': args.num_beams > 1,  # stop beam search once num_beams hypotheses are finished
+            'eos_token_id': self.tokenizer.eos_token_id,
+            'use_cache': True,
         }
 
     @property
@@ -52,6 +78,18 @@ class GenerationWrapper(object):
         if max_length:
             text = text[:max_length]
         return self.tokenizer.decode(text, skip_special_tokens=True)
+
+    def clean_by_tokenizer_batch(self, texts: List[str], max_length: int = None) -> List[str]:
+        if not texts:
+            return []
+        # a single batched call goes through the (parallel) fast tokenizer once
+        if max_length:
+            ids = self.tokenizer(
+                texts, truncation=True, max_length=max_length,
+                add_special_tokens=False, return_attention_mask=False)['input_ids']
+        else:
+            ids = self.tokenizer(texts, add_special_tokens=False, return_attention_mask=False)['input_ids']
+        return self.tokenizer.batch_decode(ids, skip_special_tokens=True)
     
     def split_by_tokenizer(self, text: str, split_length: int):
         text = self.tokenizer.encode(text, add_special_tokens=False)
@@ -61,6 +99,13 @@ class GenerationWrapper(object):
         second = self.tokenizer.decode(second, skip_special_tokens=True)
         return first, second
     
+    @staticmethod
+    def get_shard_range(total_count: int, shard_id: int, num_shards: int) -> Tuple[int, int]:
+        shard_size = math.ceil(total_count / num_shards)
+        shard_start = shard_id * shard_size
+        shard_end = min(shard_start + shard_size, total_count)
+        return shard_start, shard_end
+
     def load_data(
         self, 
         data_file: str, 
@@ -68,19 +113,34 @@ class GenerationWrapper(object):
         num_shards: int = 1,
         max_num_examples: int = None,
         process_exmaple_func: Callable = None,
-        debug: bool = False) -> Tuple[List, List, List]:
+        debug: bool = False) -> Tuple[List[Example], Tuple[int, int]]:
         # TODO: for simplicity we reuse the en-zh translation dataset
-        sources: List[str] = []
-        targets: List[str] = []
-        
         has_decoder_prefix = self.use_evidence in {'decoder_prefix', 'fixed'} or self.target_as_prefix_len > 0
-        decoder_prefixes: List[str] = [] if has_decoder_prefix else None
-        
-        with open(data_file, 'r') as fin:
+        has_specific_evidence = self.use_evidence not in {'no', 'fixed'}
+
+        # without dedup each line is one example, so the shard can be located by line number
+        # and lines of other shards are skipped before parsing
+        stream_shard = num_shards > 1 and self.use_evidence not in {'no'}
+        if stream_shard:
+            with open(data_file, 'rb') as fin:
+                total_count = sum(1 for _ in fin)
+            if max_num_examples:
+                total_count = min(total_count, max_num_examples)
+            shard_start, shard_end = self.get_shard_range(total_count, shard_id, num_shards)
+
+        # first pass: parse examples and collect raw evidences
+        examples: List[Dict] = []
+        raw_evis: List[str] = []
+        with open(data_file, 'rb') as fin:  # both json and orjson parse bytes
             prev_source = None
-            for l in fin:
+            for i, l in enumerate(fin):
+                if stream_shard:
+                    if i < shard_start:
+                        continue
+                    if i >= shard_end:
+                        break
                 
-                example = json.loads(l)['translation']
+                example = json_loads(l)['translation']
                 example = process_exmaple_func(example) if process_exmaple_func else example
 
                 source = example['en'].strip()
@@ -89,198 +149,267 @@ class GenerationWrapper(object):
                 if self.use_evidence in {'no'} and source == prev_source:
                     continue
                 prev_source = source
-                
-                # process source
-                if self.add_question_mark and re.search('[?!.]$', source) is None:
-                    source += '?'
-                source = self.source_prefix + source + self.source_suffix
-                
-                # process evidence
-                dp = ''
-                if self.use_evidence != 'no':
-                    if self.use_evidence == 'fixed':  # fixed evidence (i.e., instruction)
-                        dp += self.evidence_suffix  # TODO: use another argumenet?
-                    else:  # specific evidence
-                        evi = example['decoder_prefix'].strip()
-                        if self.max_evidence_len:
-                            evi = self.clean_by_tokenizer(evi, max_length=self.max_evidence_len)
-                        if self.add_period and re.search('[?!.]$', evi) is None:
-                            evi += '.'
-                        evi = self.evidence_prefix + evi + self.evidence_suffix
-                        if self.use_evidence == 'decoder_prefix':
-                            dp += evi
-                        elif self.use_evidence == 'encoder_suffix':
-                            source = source + ' ' + evi
-                        elif self.use_evidence == 'encoder_prefix':
-                            source = evi + ' ' + source
-                
-                # process target
-                target = example['zh'].strip()
-                if self.target_as_prefix_len > 0:
-                    target_prefix, target = self.split_by_tokenizer(target, split_length=self.target_as_prefix_len)
-                    dp = f'{dp} {target_prefix}' if len(dp) else target_prefix
-
-                # save
-                sources.append(source)
-                targets.append(target)
-                if has_decoder_prefix:
-                    decoder_prefixes.append(dp)
-                
-                if debug:
-                    print('SOURCE\t', source)
-                    print('TARGET\t', target)
-                    print('PREFIX\t', dp)
-                    input()
 
-                if max_num_examples and len(sources) >= max_num_examples:
+                examples.append(example)
+                if has_specific_evidence:
+                    raw_evis.append(example['decoder_prefix'].strip())
+
+                if max_num_examples and len(examples) >= max_num_examples:
                     break
 
-        total_count = len(sources)
-        assert len(sources) == len(targets)
-        if has_decoder_prefix:
-            assert len(sources) == len(decoder_prefixes)
+        # truncate all evidences with one batched tokenizer call
+        if has_specific_evidence and self.max_evidence_len:
+            raw_evis = self.clean_by_tokenizer_batch(raw_evis, max_length=self.max_evidence_len)
+
+        # second pass: build sources, targets, and decoder prefixes
+        data: List[Example] = [None] * len(examples)
+        for ei, example in enumerate(examples):
+            source = example['en'].strip()
+
+            # process source
+            if self.add_question_mark and not source.endswith(('?', '!', '.')):
+                source += '?'
+            source = self.source_prefix + source + self.source_suffix
+            
+            # process evidence
+            dp = ''
+            if self.use_evidence != 'no':
+                if self.use_evidence == 'fixed':  # fixed evidence (i.e., instruction)
+                    dp += self.evidence_suffix  # TODO: use another argumenet?
+                else:  # specific evidence
+                    evi = raw_evis[ei]
+                    if self.add_period and not evi.endswith(('?', '!', '.')):
+                        evi += '.'
+                    evi = self.evidence_prefix + evi + self.evidence_suffix
+                    if self.use_evidence == 'decoder_prefix':
+                        dp += evi
+                    elif self.use_evidence == 'encoder_suffix':
+                        source = source + ' ' + evi
+                    elif self.use_evidence == 'encoder_prefix':
+                        source = evi + ' ' + source
+            
+            # process target
+            target = example['zh'].strip()
+            if self.target_as_prefix_len > 0:
+                target_prefix, target = self.split_by_tokenizer(target, split_length=self.target_as_prefix_len)
+                dp = f'{dp} {target_prefix}' if len(dp) else target_prefix
+
+            # save
+            data[ei] = Example(source, target, dp if has_decoder_prefix else None)
+            
+            if debug:
+                print('SOURCE\t', source)
+                print('TARGET\t', target)
+                print('PREFIX\t', dp)
+                input()
 
         # shard
-        shard_size = math.ceil(total_count / num_shards)
-        shard_start = shard_id * shard_size
-        shard_end = min(shard_start + shard_size, total_count)
-        sources = sources[shard_start:shard_end]
-        targets = targets[shard_start:shard_end]
-        if has_decoder_prefix:
-            decoder_prefixes = decoder_prefixes[shard_start:shard_end]
+        if not stream_shard:
+            total_count = len(data)
+            shard_start, shard_end = self.get_shard_range(total_count, shard_id, num_shards)
+            data = data[shard_start:shard_end]
 
         logger.info(f'loaded data "{data_file}" from {shard_start} to {shard_end}')
 
-        return sources, targets, decoder_prefixes, (shard_start, shard_end)
+        return data, (shard_start, shard_end)
 
-    def generate_batch(
+    def prepare_batch(
         self,
-        sources: List[str],
-        targets: List[str],
-        decoder_prefixes: List[str] = None,
+        batch: List[Example],
         label_padding: int = -100,
-        only_evaluate: bool = False,
-        dry_run: bool = False) -> List[str]:
+        source_ids: List[List[int]] = None,
+        tokenizer: AutoTokenizer = None) -> Tuple[Dict[str, torch.Tensor], torch.Tensor, Callable]:
+        # all CPU-side work of a batch, tensors are pinned so that the device copy can be asynchronous
+        tokenizer = tokenizer or self.tokenizer
+        sources = [e.source for e in batch]
+        targets = [e.target for e in batch]
 
         # decoder prefix function
-        if decoder_prefixes:
-            assert len(sources) == len(decoder_prefixes) == len(targets)
-            prefix_tokens_ids = [self.tokenizer(prefix, add_special_tokens=False)['input_ids'] for prefix in decoder_prefixes]
-            def prefix_allowed_tokens_fn(batch_id: int, input_ids: torch.Tensor) -> List[int]:
-                if input_ids.shape[-1] > len(prefix_tokens_ids[batch_id]):
-                    return self._all_tokens
-                return prefix_tokens_ids[batch_id][input_ids.shape[-1] - 1]
+        if batch[0].decoder_prefix is not None:
+            decoder_prefixes = [e.decoder_prefix for e in batch]
+            prefix_tokens_ids = [tokenizer(prefix, add_special_tokens=False)['input_ids'] for prefix in decoder_prefixes]
+            prefix_lens: List[int] = [len(p) for p in prefix_tokens_ids]
+            # (batch_size, max_prefix_len) lookup table padded with -1, kept on CPU where HF calls the function
+            pref_matrix = torch.full((len(prefix_tokens_ids), max(max(prefix_lens), 1)), -1, dtype=torch.long)
+            for i, p in enumerate(prefix_tokens_ids):
+                pref_matrix[i, :len(p)] = torch.tensor(p, dtype=torch.long)
+            all_tokens = self._all_tokens
+            def prefix_allowed_tokens_fn(batch_id: int, input_ids: torch.Tensor) -> torch.LongTensor:
+                step = input_ids.shape[-1] - 1
+                if step >= prefix_lens[batch_id]:
+                    return all_tokens
+                return pref_matrix[batch_id, step:step + 1]
             targets = [f'{dp} {t}' for t, dp in zip(targets, decoder_prefixes)]  # prepend the prefix to targets
         else:
             prefix_allowed_tokens_fn = None
 
-        # tokenize
-        sources = self.tokenizer.batch_encode_plus(
-            sources, return_tensors='pt', padding=True, truncation=True)
-        sources = {k: v.to(self.device) for k, v in sources.items()}
-        targets = self.tokenizer.batch_encode_plus(
+        # tokenize (or only pad if sources are already tokenized)
+        if source_ids is not None:
+            sources = tokenizer.pad({'input_ids': source_ids}, return_tensors='pt')
+        else:
+            sources = tokenizer.batch_encode_plus(
+                sources, return_tensors='pt', padding=True, truncation=True)
+        targets = tokenizer.batch_encode_plus(
             targets, return_tensors='pt', padding=True, truncation=True, max_length=self.gen_args['max_length'])
-        labels = targets['input_ids'].to(self.device)
-        labels[labels == self.tokenizer.pad_token_id] = label_padding
+        labels = targets['input_ids']
+        labels[labels == tokenizer.pad_token_id] = label_padding
 
-        if not dry_run:  # generate
-            with torch.no_grad():
-                if not only_evaluate:
-                    output = self.model.generate(**sources, prefix_allowed_tokens_fn=prefix_allowed_tokens_fn, **self.gen_args)
-                else:
-                    output = []
-                _ = self.model(**sources, labels=labels)
-        else:
+        pin = self.device.type == 'cuda'
+        sources = {k: v.pin_memory() if pin else v for k, v in sources.items()}
+        labels = labels.pin_memory() if pin else labels
+        return sources, labels, prefix_allowed_tokens_fn
+
+    def generate_batch(
+        self,
+        batch: List[Example],
+        label_padding: int = -100,
+        only_evaluate: bool = False,
+        dry_run: bool = False,
+        source_ids: List[List[int]] = None,
+        prepared: Tuple = None) -> List[str]:
+
+        # use the output of prepare_batch if it's already computed (e.g., by prefetch_batches)
+        sources, labels, prefix_allowed_tokens_fn = prepared or self.prepare_batch(
+            batch, label_padding=label_padding, source_ids=source_ids)
+        if dry_run:
             return [(labels != label_padding).sum().item()]
 
+        # copies from pinned memory are queued on the current stream and overlap with host work
+        sources = {k: v.to(self.device, non_blocking=True) for k, v in sources.items()}
+        labels = labels.to(self.device, non_blocking=True)
+
+        # generate
+        use_amp = self.amp_dtype is not None and self.device.type == 'cuda'
+        amp = torch.autocast(device_type='cuda', dtype=self.amp_dtype) if use_amp else contextlib.nullcontext()
+        with torch.inference_mode(), amp:
+            if not only_evaluate:
+                output = self.model.generate(**sources, prefix_allowed_tokens_fn=prefix_allowed_tokens_fn, **self.gen_args)
+            else:
+                output = []
+            _ = self.model(**sources, labels=labels)
+
         # detokenize
         output = self.tokenizer.batch_decode(output, skip_special_tokens=True)
         return output
     
+    def prefetch_batches(
+        self,
+        batches: Iterable[Tuple[List[int], List[Example]]],
+        source_ids: List[List[int]]) -> Iterable[Tuple[List[int], List[Example], Tuple]]:
+        # run prepare_batch on a background thread to overlap with generation in the main thread
+        # the thread uses its own tokenizer because fast tokenizers are not safe to share across threads
+        tokenizer = copy.deepcopy(self.tokenizer)
+        prepared_queue = queue.Queue(maxsize=self.num_workers)
+
+        def produce():
+            try:
+                for batch_idx, batch in batches:
+                    prepared = self.prepare_batch(batch, source_ids=[source_ids[i] for i in batch_idx], tokenizer=tokenizer)
+                    prepared_queue.put((batch_idx, batch, prepared))
+            except Exception as e:  # re-raised in the main thread
+                prepared_queue.put(e)
+                return
+            prepared_queue.put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+        while True:
+            item = prepared_queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def write_batch(
+        self,
+        fout,
+        batch: List[Example],
+        batch_o: List[str]):
+        if not batch_o:
+            return
+        # detokenized everything with one tokenizer round-trip
+        bs = len(batch)
+        has_dp = batch[0].decoder_prefix is not None
+        clean = self.clean_by_tokenizer_batch(
+            [e.source for e in batch] + [e.target for e in batch] + ([e.decoder_prefix for e in batch] if has_dp else []))
+        clean_s = clean[:bs]
+        clean_t = clean[bs:2 * bs]
+        clean_dp = clean[2 * bs:] if has_dp else [''] * bs
+        fout.writelines([f'{s}\t{t}\t{o}\t{dp}\n' for s, t, o, dp in zip(clean_s, clean_t, batch_o, clean_dp)])
+
     def generate(
         self,
-        sources: List[str],
-        targets: List[str],
-        decoder_prefixes: List[str] = None,
+        examples: List[Example],
         output_file: str = None,
         only_evaluate: bool = False,
-        dry_run: bool = False) -> List[str]:
-
-        output: List[str] = []
-        with open(output_file, 'w') if output_file else contextlib.nullcontext() as fout, tqdm(total=len(sources)) as pbar:
-            for b in range(0, len(sources), self.batch_size):
-                batch_s = sources[b : b + self.batch_size]
-                batch_t = targets[b : b + self.batch_size] if targets else None
-                batch_dp = decoder_prefixes[b : b + self.batch_size] if decoder_prefixes else None
-                batch_o = self.generate_batch(batch_s, targets=batch_t, decoder_prefixes=batch_dp, only_evaluate=only_evaluate, dry_run=dry_run)
-
-                if output_file:
-                    for i, o in enumerate(batch_o):
-                        # detokenized everything
-                        s = self.clean_by_tokenizer(batch_s[i])
-                        t = self.clean_by_tokenizer(batch_t[i]) if batch_t else ''
-                        dp = self.clean_by_tokenizer(batch_dp[i]) if batch_dp else ''
-                        fout.write(f'{s}\t{t}\t{o}\t{dp}\n')
-
-                output.extend(batch_o)
-                pbar.update(len(batch_s))
+        dry_run: bool = False,
+        sort_by_length: bool = False,
+        dedup: bool = False) -> List[str]:
+
+        # tokenize all sources in one call and only pad per batch
+        source_ids: List[List[int]] = self.tokenizer(
+            [e.source for e in examples], truncation=True, return_attention_mask=False)['input_ids']
+
+        # outputs are aligned with examples only when actually generating
+        sort_by_length = sort_by_length and not only_evaluate and not dry_run
+        dedup = dedup and not only_evaluate and not dry_run
+        order: List[int] = list(range(len(examples)))
+        first_idx: List[int] = None
+        if dedup:  # only generate for the first occurrence of each (source, decoder prefix)
+            key2idx: Dict[Tuple[str, str], int] = {}
+            first_idx = [key2idx.setdefault((e.source, e.decoder_prefix), i) for i, e in enumerate(examples)]
+            order = [i for i in order if first_idx[i] == i]
+        if sort_by_length:  # batch examples with similar lengths to reduce padding
+            order = sorted(order, key=lambda i: len(source_ids[i]))
+        reorder = sort_by_length or dedup
+
+        output: List[str] = [None] * len(examples) if reorder else []
+        src: List[int] = first_idx if dedup else list(range(len(examples)))  # which generated output each example takes
+        written = 0  # with reorder, examples before this are already written
+        batches = ((order[b : b + self.batch_size], [examples[i] for i in order[b : b + self.batch_size]])
+            for b in range(0, len(order), self.batch_size))
+        if self.num_workers > 0:
+            batches = self.prefetch_batches(batches, source_ids)
+        else:
+            batches = ((batch_idx, batch, None) for batch_idx, batch in batches)
+
+        with open(output_file, 'w', buffering=1 << 20) if output_file else contextlib.nullcontext() as fout, tqdm(total=len(order)) as pbar:
+            for batch_idx, batch, prepared in batches:
+                batch_o = self.generate_batch(
+                    batch, only_evaluate=only_evaluate, dry_run=dry_run,
+                    source_ids=[source_ids[i] for i in batch_idx], prepared=prepared)
+
+                if reorder:  # put outputs back to their original positions
+                    for i, o in zip(batch_idx, batch_o):
+                        output[i] = o
+                    # write the longest finished prefix (in the original order) so an interrupted run keeps it
+                    ready = written
+                    while ready < len(examples) and output[src[ready]] is not None:
+                        ready += 1
+                    if output_file:
+                        for b in range(written, ready, self.batch_size):
+                            e = min(b + self.batch_size, ready)
+                            self.write_batch(fout, examples[b:e], [output[src[i]] for i in range(b, e)])
+                    written = ready
+                else:
+                    if output_file:
+                        self.write_batch(fout, batch, batch_o)
+                    output.extend(batch_o)
+                pbar.update(len(batch))
+
+            if dedup:  # copy outputs to duplicates
+                output = [output[i] for i in first_idx]
     
         return output
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    # data args
-    parser.add_argument('--data_file', type=str, required=True, help='data file')
-    parser.add_argument('--out_file', type=str, default=None, help='output file')
-    parser.add_argument('--source_prefix', type=str, default='', help='source prefix')
-    parser.add_argument('--source_suffix', type=str, default='', help='source suffix')
-    parser.add_argument('--evidence_prefix', type=str, default='', help='decoder prefix prefix')
-    parser.add_argument('--evidence_suffix', type=str, default='', help='decoder prefix suffix')
-    parser.add_argument('--evidence_encoder_input', type=str, default='', help='input to encoder when building the index of evidences')
-    parser.add_argument('--use_evidence', type=str, default='no', 
-        choices=['no', 'encoder_suffix', 'encoder_prefix', 'decoder_prefix', 'fixed'], help='use evidence in which position')
-    parser.add_argument('--max_gen_len', type=int, default=256, help='max generation length')
-    parser.add_argument('--max_evidence_len', type=int, default=128, help='max evidence length')
-    parser.add_argument('--target_as_prefix_len', type=int, default=0, help='number of tokens in the target used as prefix')
-
-    # datastore args
-    parser.add_argument('--dstore_dir', type=str, default=None, help='datastore directory')
-    parser.add_argument('--dstore_size', type=int, default=None, help='datastore size')
-
-    # model args
-    parser.add_argument('--model', type=str, required=True, help='model')
-    parser.add_argument('--batch_size', type=int, default=4, help='batch size')
-    parser.add_argument('--stage', type=str, default='retrieve', choices=['save', 'retrieve'], help='save or retrieve')
-    parser.add_argument('--retrieval_topk', type=int, default=0, help='topk tokens retrieved in decoder. 0 deactivates retreival')
-    parser.add_argument('--retrieval_layers', type=str, default='[0]', help='python code of layers, e.g., list(range(24)) for all layers')
-    parser.add_argument('--retrieval_track', type=str, default=False, help='file to track retrieval')
-    parser.add_argument('--skip_retrieval_steps', type=int, default=0, help='number of steps to skip retrieval')
-    parser.add_argument('--accum_retrieval_steps', type=int, default=0, help='number of accumulation steps for retrieval')
-    parser.add_argument('--retrieval_for_next_step_at_layer', type=int, default=-1, help='perform retrieval for the next step at this layer')
-    parser.add_argument('--retrieval_every_steps', type=int, default=1, help='block-wise retrieval')
-    parser.add_argument('--max_retrieval_times', type=int, default=None, help='max number of retrieval to perform')
-    parser.add_argument('--filter_topk', type=int, default=0, help='filter_topk')
-    parser.add_argument('--filter_order', type=str, default='original', help='filter_order')
-    parser.add_argument('--only_use_head_idx', type=str, default="-1", help='head index to use (could be an integer or a list)')
-    parser.add_argument('--num_ctxs', type=int, default=1, help='num of ctxs to retrieve')
-    parser.add_argument('--ctx_order', type=str, default='parallel', help='how to ues multiple ctxs')
-    args = parser.parse_args()
-    args.is_save = args.stage == 'save'
-    args.use_retrieval = args.is_save or args.retrieval_topk > 0
-    args.retrieval_layers = eval(args.retrieval_layers)
-    args.only_use_head_idx = eval(args.only_use_head_idx)
-
-    # logging config
+def setup_logging():
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
         datefmt="%m/%d/%Y %H:%M:%S",
         handlers=[logging.StreamHandler(sys.stdout)],
     )
 
-    # setup slurm
-    setup_multi_gpu_slurm(args)
-    logger.info(args)
-
+def main(args):
     # modify output path
     args.out_file = (args.out_file + f'.{args.global_rank}') if type(args.out_file) is str else args.out_file
     args.retrieval_track = (args.retrieval_track + f'.{args.global_rank}') if type(args.retrieval_track) is str else args.retrieval_track
@@ -289,8 +418,21 @@ if __name__ == '__main__':
     args.dstore_device = torch.device('cpu') if len(args.retrieval_layers) > 3 else args.device
 
     # load model
-    model = AutoModelForSeq2SeqLM.from_pretrained(args.model).to(args.device)
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model_kwargs = {}
+    if args.attn_implementation != 'eager' and not args.use_retrieval:  # retrieval patches the eager T5Attention
+        model_kwargs['attn_implementation'] = args.attn_implementation
+    try:
+        model = AutoModelForSeq2SeqLM.from_pretrained(args.model, **model_kwargs)
+    except (TypeError, ValueError, ImportError) as e:  # backend not supported by this model/transformers version
+        logger.warning(f'{args.attn_implementation} attention is not available ({e}), fall back to eager')
+        model = AutoModelForSeq2SeqLM.from_pretrained(args.model)
+    model = model.to(args.device)
+    model.config.use_cache = True  # some T5 checkpoints ship with use_cache disabled
+    if args.compile:  # patch forward (not the module) so that parameter names and get_encoder() are unchanged
+        model.encoder.forward = torch.compile(model.encoder.forward, dynamic=True)
+        if not args.use_retrieval:  # retrieval-augmented decoder layers are patched later and run numpy/faiss code
+            model.decoder.forward = torch.compile(model.decoder.forward, dynamic=True)
+    tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
     wrapper = GenerationWrapper(model, tokenizer, args)
 
     # load data
@@ -301,23 +443,27 @@ if __name__ == '__main__':
             if args.evidence_encoder_input:  # use the same encoder input for all evidences
                 example['en'] = args.evidence_encoder_input
             return example
-    sources, targets, decoder_prefixes, (shard_start, shard_end) = wrapper.load_data(
+    examples, (shard_start, shard_end) = wrapper.load_data(
         args.data_file, shard_id=args.global_rank, num_shards=args.world_size, 
         process_exmaple_func=process_exmaple_func, max_num_examples=None)
 
     # prepare for "save" stage
     only_evaluate = False
     if args.is_save:
-        num_tokens = wrapper.generate(sources, targets=targets, decoder_prefixes=decoder_prefixes, dry_run=True)
+        num_tokens = wrapper.generate(examples, dry_run=True)
         num_tokens = sum(num_tokens)
         logger.info(f'total eval tokens: {num_tokens}')
         args.dstore_size = num_tokens
         only_evaluate = True
 
     if args.use_retrieval:  # add retrieval
+        if args.dstore_token_dtype == 'int16' and model.config.vocab_size > 32768:
+            raise ValueError(f'vocab size {model.config.vocab_size} does not fit in int16 tokens')
         ret_wrapper = MemTransWrapper(
             dstore_size=args.dstore_size, dstore_dir=args.dstore_dir,
-            move_dstore_to_mem=True, device=args.dstore_device,
+            move_dstore_to_mem=True, use_torch_search=args.use_torch_search, device=args.dstore_device,
+            dstore_precision=args.dstore_precision, index_type=args.index_type, nprobe=args.nprobe, target_recall=args.target_recall,
+            token_dtype=args.dstore_token_dtype, compile=args.compile,
             recompute_dists=True, retrieval_layers=args.retrieval_layers,
             k=args.retrieval_topk, stage=args.stage, track=args.retrieval_track, 
             by_ids=False, cache_indices=True,  # TODO: debug
@@ -335,14 +481,103 @@ if __name__ == '__main__':
 
     # generate
     wrapper.generate(
-        sources, 
-        targets=targets, 
-        decoder_prefixes=decoder_prefixes, 
+        examples, 
         only_evaluate=only_evaluate,
-        output_file=args.out_file)
+        output_file=args.out_file,
+        sort_by_length=args.sort_by_length and not args.use_retrieval,  # datastore ids follow the example order
+        dedup=args.dedup and not args.use_retrieval)  # datastore ids follow the example order
     
     if args.is_save:  # build index
         ret_wrapper.build_index()
     
     if args.use_retrieval:
         ret_wrapper.break_out()
+
+def _worker(rank: int, args):
+    # one process per local GPU, each owning an independent shard (same layout as slurm ranks)
+    setup_logging()
+    args.local_rank = args.global_rank = rank
+    args.world_size = torch.cuda.device_count()
+    args.is_multi = True
+    args.device = torch.device(f'cuda:{rank}')
+    torch.cuda.set_device(args.device)
+    logger.info(f'Spawned job: global rank {args.global_rank}, GPU device {args.device}')
+    main(args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # data args
+    parser.add_argument('--data_file', type=str, required=True, help='data file')
+    parser.add_argument('--out_file', type=str, default=None, help='output file')
+    parser.add_argument('--source_prefix', type=str, default='', help='source prefix')
+    parser.add_argument('--source_suffix', type=str, default='', help='source suffix')
+    parser.add_argument('--evidence_prefix', type=str, default='', help='decoder prefix prefix')
+    parser.add_argument('--evidence_suffix', type=str, default='', help='decoder prefix suffix')
+    parser.add_argument('--evidence_encoder_input', type=str, default='', help='input to encoder when building the index of evidences')
+    parser.add_argument('--use_evidence', type=str, default='no', 
+        choices=['no', 'encoder_suffix', 'encoder_prefix', 'decoder_prefix', 'fixed'], help='use evidence in which position')
+    parser.add_argument('--max_gen_len', type=int, default=256, help='max generation length')
+    parser.add_argument('--num_beams', type=int, default=1, help='number of beams (early stopping is used when > 1)')
+    parser.add_argument('--max_evidence_len', type=int, default=128, help='max evidence length')
+    parser.add_argument('--target_as_prefix_len', type=int, default=0, help='number of tokens in the target used as prefix')
+
+    # datastore args
+    parser.add_argument('--dstore_dir', type=str, default=None, help='datastore directory')
+    parser.add_argument('--dstore_size', type=int, default=None, help='datastore size')
+    parser.add_argument('--dstore_precision', type=str, default='fp32', choices=['fp32', 'fp16', 'int8'], help='storage precision of datastore keys and values (int8 with per-row scales)')
+    parser.add_argument('--dstore_token_dtype', type=str, default='int32', choices=['int32', 'int16'], help='storage dtype of datastore tokens (int16 requires vocab < 32768, e.g., T5)')
+    parser.add_argument('--index_type', type=str, default='flat', choices=['flat', 'ivfpq'], help='faiss index type')
+    parser.add_argument('--nprobe', type=int, default=32, help='number of inverted lists to visit for ivfpq')
+    parser.add_argument('--target_recall', type=float, default=None, help='tune nprobe of ivfpq to reach this recall@k (overrides nprobe)')
+    parser.add_argument('--use_torch_search', action='store_true', help='exact search with torch matmul instead of faiss indices')
+
+    # model args
+    parser.add_argument('--model', type=str, required=True, help='model')
+    parser.add_argument('--batch_size', type=int, default=4, help='batch size')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of batches tokenized ahead on a background thread (0 disables)')
+    parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'], help='autocast dtype on GPU (bf16 for A100/H100, fp16 for V100/T4)')
+    parser.add_argument('--attn_implementation', type=str, default='eager', choices=['eager', 'sdpa', 'flash_attention_2'], help='attention backend (ignored with retrieval)')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the encoder and the decoder (only its attention computation with retrieval)')
+    parser.add_argument('--sort_by_length', action='store_true', help='batch examples with similar source lengths (disabled with retrieval)')
+    parser.add_argument('--dedup', action='store_true', help='generate once for repeated (source, decoder prefix) pairs (disabled with retrieval)')
+    parser.add_argument('--spawn_local_gpus', action='store_true', help='without slurm, run one process per local GPU (each loads its own datastore) and merge the outputs')
+    parser.add_argument('--stage', type=str, default='retrieve', choices=['save', 'retrieve'], help='save or retrieve')
+    parser.add_argument('--retrieval_topk', type=int, default=0, help='topk tokens retrieved in decoder. 0 deactivates retreival')
+    parser.add_argument('--retrieval_layers', type=str, default='[0]', help='python code of layers, e.g., list(range(24)) for all layers')
+    parser.add_argument('--retrieval_track', type=str, default=False, help='file to track retrieval')
+    parser.add_argument('--skip_retrieval_steps', type=int, default=0, help='number of steps to skip retrieval')
+    parser.add_argument('--accum_retrieval_steps', type=int, default=0, help='number of accumulation steps for retrieval')
+    parser.add_argument('--retrieval_for_next_step_at_layer', type=int, default=-1, help='perform retrieval for the next step at this layer')
+    parser.add_argument('--retrieval_every_steps', type=int, default=1, help='block-wise retrieval')
+    parser.add_argument('--max_retrieval_times', type=int, default=None, help='max number of retrieval to perform')
+    parser.add_argument('--filter_topk', type=int, default=0, help='filter_topk')
+    parser.add_argument('--filter_order', type=str, default='original', help='filter_order')
+    parser.add_argument('--only_use_head_idx', type=str, default="-1", help='head index to use (could be an integer or a list)')
+    parser.add_argument('--num_ctxs', type=int, default=1, help='num of ctxs to retrieve')
+    parser.add_argument('--ctx_order', type=str, default='parallel', help='how to ues multiple ctxs')
+    args = parser.parse_args()
+    args.is_save = args.stage == 'save'
+    args.use_retrieval = args.is_save or args.retrieval_topk > 0
+    args.retrieval_layers = eval(args.retrieval_layers)
+    args.only_use_head_idx = eval(args.only_use_head_idx)
+
+    # logging config
+    setup_logging()
+
+    # setup slurm
+    setup_multi_gpu_slurm(args)
+    logger.info(args)
+
+    # the save stage builds a single datastore so it always runs in one process
+    num_gpus = torch.cuda.device_count()
+    if args.spawn_local_gpus and args.world_size == 1 and num_gpus > 1 and not args.is_save:
+        torch.multiprocessing.spawn(_worker, nprocs=num_gpus, args=(args,))
+        if type(args.out_file) is str:  # merge shard outputs in rank order into out_file
+            with open(args.out_file, 'w') as fout:
+                for rank in range(num_gpus):
+                    with open(args.out_file + f'.{rank}') as fin:
+                        shutil.copyfileobj(fin, fout)
+            for rank in range(num_gpus):
+                os.remove(args.out_file + f'.{rank}')
+    else:
+        main(args)
@@ -1,10 +1,11 @@
 from typing import Tuple, Union, List, Dict
 import os
+import mmap
 import logging
 import time
-import types
 import json
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future
 from tqdm import tqdm
 import numpy as np
 import torch
@@ -14,6 +15,10 @@ import torch_scatter
 import faiss
 import faiss.contrib.torch_utils
 from transformers.models.t5.modeling_t5 import T5Attention
+try:
+    from numba import njit  # single-pass offset scan over large dstores
+except ImportError:
+    njit = None
 
 from knnlm import get_dstore_path
 from utils import StridedTensor
@@ -21,8 +26,39 @@ from utils import StridedTensor
 logger = logging.getLogger(__name__)
 logger.setLevel(20)
 
-def get_index_path(dstore_dir, model_type, dstore_size, dimension, head_idx):
-    return f'{dstore_dir}/index_{model_type}_{dstore_size}_{dimension}_{head_idx}.indexed'
+def _compute_offsets_np(ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, bool]:
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), True
+    start_offsets = np.concatenate(([0], np.nonzero(np.diff(ids))[0] + 1))  # inclusive
+    end_offsets = np.concatenate((start_offsets[1:], [len(ids)]))  # exclusive
+    consecutive = np.array_equal(ids[start_offsets], np.arange(len(start_offsets)))
+    return start_offsets, end_offsets, consecutive
+
+def _compute_offsets_nb(ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, bool]:
+    # sized by the number of tokens (an upper bound of the number of ids whatever the ids are) and trimmed on return
+    start_offsets = np.zeros(len(ids), dtype=np.int64)
+    end_offsets = np.zeros(len(ids), dtype=np.int64)
+    if len(ids) == 0:
+        return start_offsets, end_offsets, True
+    if ids[0] != 0:
+        return start_offsets[:0], end_offsets[:0], False
+    cur = 0
+    for i in range(1, len(ids)):
+        if ids[i] != ids[i - 1]:
+            if ids[i] != ids[i - 1] + 1:
+                return start_offsets[:cur + 1], end_offsets[:cur + 1], False
+            end_offsets[cur] = i
+            cur += 1
+            start_offsets[cur] = i
+    end_offsets[cur] = len(ids)
+    return start_offsets[:cur + 1], end_offsets[:cur + 1], True
+
+# build start/end offsets of each id (assuming ids are consecutive and start with 0)
+compute_offsets = _compute_offsets_np if njit is None else njit(_compute_offsets_nb)
+
+def get_index_path(dstore_dir, model_type, dstore_size, dimension, head_idx, index_type='flat'):
+    suffix = '' if index_type == 'flat' else f'_{index_type}'
+    return f'{dstore_dir}/index_{model_type}_{dstore_size}_{dimension}_{head_idx}{suffix}.indexed'
 
 class FixedRetrieval(object):
     def __init__(self, line2did_file: str, fid_file: str):
@@ -55,7 +91,92 @@ fixed_retrieval = FixedRetrieval(
 class MemTransAttnCoordinator(object):
     def __init__(self):
         self._key_length: int = None  # track the decoding step
+        self._labels: torch.LongTensor = None  # (batch_size, seq_length) labels of the current batch
+        self._label_decoder_input_ids: torch.LongTensor = None  # (batch_size, seq_length) decoder inputs built from labels
+        self._decoder_input_ids: torch.LongTensor = None  # (batch_size, seq_length) inputs of the current decoder forward
         self._indices: torch.LongTensor = None  # (batch_size, topk) track the retrieved indices
+        self._mask: Tuple[torch.Tensor, torch.FloatTensor] = None  # (source mask, additive float mask) shared by layers
+        self._position_bias: Tuple[Tuple, torch.FloatTensor] = None  # (key, extended position bias) shared by layers
+        self._attns: List['MemTransAttn'] = []  # layers that reuse the cached indices
+        self._rel_bias: Tuple[int, Tuple, torch.FloatTensor] = None  # (radius, weight ref, relative position bias table)
+        self._pool: ThreadPoolExecutor = None
+        self._prefetched_key_length: int = None
+        self._prefetched: Dict[int, Future] = {}  # layer_index -> results of get_knns_by_indices
+    
+    def save_labels(
+        self, 
+        labels: torch.LongTensor,  # (batch_size, seq_length)
+        decoder_input_ids: torch.LongTensor = None):  # (batch_size, seq_length)
+        # saved once per forward for all layers
+        self._labels = labels
+        self._label_decoder_input_ids = self._decoder_input_ids = decoder_input_ids
+    
+    def get_labels(self) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        return self._labels, self._label_decoder_input_ids
+    
+    def save_decoder_input_ids(self, decoder_input_ids: torch.LongTensor):  # (batch_size, seq_length)
+        self._decoder_input_ids = decoder_input_ids  # should be consistent with save_labels
+    
+    def get_decoder_input_ids(self) -> torch.LongTensor:
+        return self._decoder_input_ids
+    
+    def relative_position_bias(
+        self, 
+        attn: T5Attention, 
+        query_length: int, 
+        key_length: int, 
+        seq_length: int) -> torch.FloatTensor:  # (1, n_heads, seq_length, key_length)
+        # same as attn.compute_bias(query_length, key_length)[:, :, -seq_length:] but sliced out of a cached table.
+        # T5's bias only depends on key_pos - query_pos, so one (n_heads, 2 * radius - 1) table over relative positions
+        # (shared by all layers since they share relative_attention_bias) covers every step
+        weight = attn.relative_attention_bias.weight
+        radius = max(query_length, key_length)
+        if self._rel_bias is None or self._rel_bias[0] < radius or self._rel_bias[1] != (weight.data_ptr(), weight.device):
+            radius = 2 * radius  # grow geometrically
+            relative_position = torch.arange(1 - radius, radius, dtype=torch.long, device=weight.device)
+            bucket = attn._relative_position_bucket(
+                relative_position, bidirectional=(not attn.is_decoder), 
+                num_buckets=attn.relative_attention_num_buckets, max_distance=attn.relative_attention_max_distance)
+            table = attn.relative_attention_bias(bucket).t()  # (n_heads, 2 * radius - 1), index r is relative position r + 1 - radius
+            self._rel_bias = (radius, (weight.data_ptr(), weight.device), table)
+        radius, _, table = self._rel_bias
+        # query position i attends to relative positions -i ... key_length - 1 - i, i.e., the window starting at radius - 1 - i
+        windows = table.unfold(1, key_length, 1)  # (n_heads, n_windows, key_length)
+        first, last = query_length - seq_length, query_length - 1
+        rows = windows[:, radius - 1 - last:radius - first].flip(1)  # (n_heads, seq_length, key_length) increasing positions
+        return rows.unsqueeze(0)
+    
+    def register(self, mta: 'MemTransAttn'):
+        self._attns.append(mta)
+    
+    def prefetch(
+        self, 
+        key_length: int, 
+        indices: torch.LongTensor,  # (batch_size, n_ctxs, topk)
+        device: torch.device, 
+        skip_layer: int):
+        # gather keys and values of the other layers in the background while the following layers compute
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        self._prefetched_key_length = key_length
+        self._prefetched = {
+            mta.layer_index: self._pool.submit(mta.dstore.get_knns_by_indices, indices=indices, device=device, return_all=mta.is_track)
+            for mta in self._attns if mta.layer_index != skip_layer}
+    
+    def get_prefetched(self, key_length: int, layer_index: int):
+        if self._prefetched_key_length != key_length:
+            return None
+        future = self._prefetched.pop(layer_index, None)
+        return future.result() if future is not None else None
+    
+    def get_float_mask(self, mask: torch.Tensor, dtype: torch.dtype) -> torch.FloatTensor:
+        # T5 passes the same (usually already additive) mask to all layers, so convert a boolean one only once
+        if mask is None or mask.dtype != torch.bool:
+            return mask
+        if self._mask is None or self._mask[0] is not mask or self._mask[1].dtype != dtype:
+            float_mask = torch.zeros(mask.size(), dtype=dtype, device=mask.device).masked_fill_(~mask, torch.finfo(dtype).min)
+            self._mask = (mask, float_mask)
+        return self._mask[1]
     
     def get_or_save_indices(
         self, 
@@ -71,8 +192,23 @@ class MemTransAttnCoordinator(object):
                 self._key_length = key_length
                 self._indices = indices
     
+    def get_or_save_position_bias(
+        self, 
+        mask: torch.FloatTensor, 
+        lengths: Tuple[int, ...],  # (seq_length, real_seq_length, key_length, topk)
+        position_bias: torch.FloatTensor = None):
+        # all retrieval layers share relative_attention_bias and receive the same mask object,
+        # so the extended bias only depends on the step
+        if position_bias is None:  # get
+            if self._position_bias is not None and self._position_bias[0][0] is mask and self._position_bias[0][1:] == lengths:
+                return self._position_bias[1]
+            return None
+        self._position_bias = ((mask,) + tuple(lengths), position_bias)  # save
+    
     def clear(self):
-        self._key_length = self._indices = None
+        self._key_length = self._indices = self._mask = self._position_bias = None
+        self._prefetched_key_length = None
+        self._prefetched = {}
 
 class MemTransDatastore(object):
     def __init__(
@@ -82,6 +218,12 @@ class MemTransDatastore(object):
         dimension: int, 
         n_heads: int, 
         move_dstore_to_mem: bool = False, 
+        use_torch_search: bool = False,
+        precision: str = 'fp32',  # storage precision of keys and values (retrieved ones are returned in fp32), int8 uses per-row scales
+        index_type: str = 'flat',  # 'flat' (exact) or 'ivfpq' (approximate)
+        nprobe: int = 32,  # number of inverted lists visited by ivfpq
+        token_dtype: str = 'int32',  # 'int16' halves the tokens file when the vocab has fewer than 32768 entries
+        gpu_temp_memory: int = 64 << 20,  # scratch memory reserved by the gpu resources of each head
         device: torch.device = None):
         self.directory = directory
         self.model_type = model_type
@@ -89,9 +231,21 @@ class MemTransDatastore(object):
         self.dimension = dimension
         self.n_heads = n_heads
         self.move_dstore_to_mem = move_dstore_to_mem
+        # exact inner-product search with a batched matmul over in-memory keys instead of faiss flat indices
+        self.use_torch_search = use_torch_search
+        assert not use_torch_search or move_dstore_to_mem, 'torch search requires the dstore in memory'
+        assert index_type in {'flat', 'ivfpq'}
+        assert not use_torch_search or index_type == 'flat', 'torch search is exact'
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.gpu_temp_memory = gpu_temp_memory
         self.device = torch.device('cpu') if device is None else device
         self.cur_idx = 0
-        self.precision = np.float32
+        assert precision in {'fp32', 'fp16', 'int8'}
+        assert not use_torch_search or precision != 'int8', 'torch search needs float keys'
+        self.precision = {'fp32': np.float32, 'fp16': np.float16, 'int8': np.int8}[precision]
+        assert token_dtype in {'int32', 'int16'}
+        self.token_dtype = {'int32': np.int32, 'int16': np.int16}[token_dtype]
         self.load_or_init_dstore()
         self.head2ids: Dict[int, List] = defaultdict(list)  # each item in list is (batch_size, final_topk)
     
@@ -99,18 +253,28 @@ class MemTransDatastore(object):
     def use_cuda(self):
         return self.device.type == 'cuda'
     
+    @property
+    def is_quantized(self):
+        return self.precision == np.int8
+
     @property
     def num_docs(self):
         return len(self.lengths)
 
     def get_index_path(self, head_idx: int) -> str:
-        return get_index_path(self.directory, self.model_type, self.size, self.dimension, head_idx=head_idx)
+        return get_index_path(self.directory, self.model_type, self.size, self.dimension, head_idx=head_idx, index_type=self.index_type)
     
+    def get_scale_path(self) -> Tuple[str, str]:
+        prefix = get_dstore_path(self.directory, self.model_type, self.size, self.dimension)
+        return f'{prefix}_keys_int8_scales.npy', f'{prefix}_vals_int8_scales.npy'
+
     def get_dstore_path(self) -> Tuple[str, str, str, str]:
         prefix = get_dstore_path(self.directory, self.model_type, self.size, self.dimension)
-        key_file = f'{prefix}_keys.npy'
-        val_file = f'{prefix}_vals.npy'
-        tok_file = f'{prefix}_tokens.npy'
+        suffix = '' if self.precision == np.float32 else f'_{np.dtype(self.precision).name}'  # keep fp32 file names unchanged
+        key_file = f'{prefix}_keys{suffix}.npy'
+        val_file = f'{prefix}_vals{suffix}.npy'
+        tok_suffix = '' if self.token_dtype == np.int32 else f'_{np.dtype(self.token_dtype).name}'
+        tok_file = f'{prefix}_tokens{tok_suffix}.npy'
         id_file = f'{prefix}_ids.npy'
         return key_file, val_file, tok_file, id_file
     
@@ -124,29 +288,52 @@ class MemTransDatastore(object):
             Path(key_file).parent.mkdir(parents=True, exist_ok=True)
         self.keys = np.memmap(key_file, dtype=self.precision, mode=mode, shape=(self.n_heads, self.size, self.dimension))
         self.values = np.memmap(val_file, dtype=self.precision, mode=mode, shape=(self.n_heads, self.size, self.dimension))
+        self.key_scales = self.value_scales = None  # (n_heads, size) absmax / 127 of each int8 row
+        if self.is_quantized:
+            key_scale_file, val_scale_file = self.get_scale_path()
+            self.key_scales = np.memmap(key_scale_file, dtype=np.float16, mode=mode, shape=(self.n_heads, self.size))
+            self.value_scales = np.memmap(val_scale_file, dtype=np.float16, mode=mode, shape=(self.n_heads, self.size))
+        if mode == 'r':  # knn lookups touch scattered rows, so sequential readahead only pollutes the page cache
+            self._madvise('MADV_RANDOM', self.keys, self.values)
         try:  # load tokens and ids if exists
-            self.tokens = np.memmap(tok_file, dtype=np.int32, mode=mode, shape=(self.size))
+            self.tokens = np.memmap(tok_file, dtype=self.token_dtype, mode=mode, shape=(self.size))
             self.ids = np.memmap(id_file, dtype=np.int32, mode=mode, shape=(self.size))
             self.positions = np.arange(self.size, dtype=np.int32)  # TODO: make it a memmap?
         except:
             self.tokens = self.ids = self.positions = None
         logger.info(f'Loading dstore took {time.time() - start} s')
     
-    def save_labels(
-        self, 
-        labels: torch.LongTensor,  # (batch_size, seq_length)
-        decoder_input_ids: torch.LongTensor = None):  # (batch_size, seq_length)
-        self._labels = labels
-        self._decoder_input_ids = decoder_input_ids
-    
-    def get_labels(self):
-        return self._labels, self._decoder_input_ids
-    
-    def save_decoder_input_ids(self, decoder_input_ids: torch.LongTensor):  # (batch_size, seq_length)
-        self._decoder_input_ids = decoder_input_ids  # should be consistent with save_labels
-    
-    def get_decoder_input_ids(self):
-        return self._decoder_input_ids
+    @staticmethod
+    def _madvise(advice: str, *arrs: np.ndarray):
+        advice = getattr(mmap, advice, None)  # only available with python 3.8+ on some platforms
+        for arr in arrs:
+            mm = getattr(arr, '_mmap', None)
+            if advice is not None and mm is not None:
+                mm.madvise(advice)
+
+    def _to_host(self, tensor: torch.Tensor, buffer_name: str, dtype: torch.dtype) -> torch.Tensor:
+        if not tensor.is_cuda:
+            # numpy casts while writing into the memmap, so only dtypes numpy doesn't know need a torch cast
+            return tensor.detach().to(dtype) if tensor.dtype == torch.bfloat16 else tensor.detach()
+        # copy into a reused pinned buffer (grown on demand) instead of allocating pageable memory every call
+        buffer = getattr(self, buffer_name, None)
+        if buffer is None or buffer.numel() < tensor.numel():
+            buffer = torch.empty(tensor.numel(), dtype=dtype, pin_memory=True)
+            setattr(self, buffer_name, buffer)
+        host = buffer[:tensor.numel()].view(tensor.size())
+        host.copy_(tensor, non_blocking=True)
+        return host
+
+    @staticmethod
+    def quantize(states: torch.FloatTensor) -> Tuple[torch.Tensor, torch.Tensor]:  # (..., dim) -> int8 (..., dim), fp16 (...)
+        scales = states.float().abs().amax(-1).clamp_(min=1e-6) / 127
+        return (states / scales.unsqueeze(-1)).round_().clamp_(-127, 127).to(torch.int8), scales.half()
+
+    @staticmethod
+    def dequantize(states: torch.Tensor, scales: torch.Tensor = None) -> torch.FloatTensor:  # (..., dim), (...)
+        if scales is None:  # not quantized
+            return states.float()
+        return states.float() * scales.float().unsqueeze(-1)
 
     def save_key_value(
         self,
@@ -168,13 +355,32 @@ class MemTransDatastore(object):
             tokens = tokens[:nt] if tokens is not None else tokens
             ids = ids[:nt] if ids is not None else ids
         
-        # save to memmap
+        # copy to host (casting to the storage dtypes on the fly, which also handles bf16 states under autocast)
+        if self.is_quantized:  # quantize on the device so that only int8 rows and their scales are copied
+            (keys, key_scales), (values, value_scales) = self.quantize(keys), self.quantize(values)
+            key_scales = self._to_host(key_scales, '_host_key_scales', torch.float16)
+            value_scales = self._to_host(value_scales, '_host_value_scales', torch.float16)
+            float_dtype = torch.int8
+        else:
+            float_dtype = torch.float16 if self.precision == np.float16 else torch.float32
+        keys = self._to_host(keys, '_host_keys', float_dtype)
+        values = self._to_host(values, '_host_values', float_dtype)
+        if tokens is not None:
+            tokens = self._to_host(tokens, '_host_tokens', torch.int16 if self.token_dtype == np.int16 else torch.int32)
+            ids = self._to_host(ids, '_host_ids', torch.int32)
+        if keys.is_pinned():  # wait for all the asynchronous copies at once
+            torch.cuda.current_stream().synchronize()
+
+        # save to memmap (a single copy per array, casting to the storage dtype if needed)
         try:
-            self.keys[:, self.cur_idx:(nt + self.cur_idx)] = keys.cpu().numpy().astype(self.precision)
-            self.values[:, self.cur_idx:(nt + self.cur_idx)] = values.cpu().numpy().astype(self.precision)
+            self.keys[:, self.cur_idx:(nt + self.cur_idx)] = keys.numpy()
+            self.values[:, self.cur_idx:(nt + self.cur_idx)] = values.numpy()
+            if self.is_quantized:
+                self.key_scales[:, self.cur_idx:(nt + self.cur_idx)] = key_scales.numpy()
+                self.value_scales[:, self.cur_idx:(nt + self.cur_idx)] = value_scales.numpy()
             if tokens is not None:
-                self.tokens[self.cur_idx:(nt + self.cur_idx)] = tokens.cpu().numpy().astype(np.int32)
-                self.ids[self.cur_idx:(nt + self.cur_idx)] = ids.cpu().numpy().astype(np.int32)
+                self.tokens[self.cur_idx:(nt + self.cur_idx)] = tokens.numpy()
+                self.ids[self.cur_idx:(nt + self.cur_idx)] = ids.numpy()
         except ValueError as ex:
             logger.error(f'Error saving datastore with mode {self.keys.mode}, did you try to save an already existing datastore?')
             logger.error(f'Delete the files {self.keys.filename} and {self.values.filename} and try again')
@@ -182,84 +388,240 @@ class MemTransDatastore(object):
 
         self.cur_idx += nt
 
+    def create_index(self):
+        if self.index_type == 'flat':
+            return faiss.IndexFlatIP(self.dimension)
+        # ivfpq: sublinear search over nprobe of the sqrt-scaled number of lists, keys compressed to 1 byte per 8 dims
+        nlist = max(int(4 * np.sqrt(self.cur_idx)), 1)
+        quantizer = faiss.IndexFlatIP(self.dimension)
+        index = faiss.IndexIVFPQ(quantizer, self.dimension, nlist, max(self.dimension // 8, 1), 8, faiss.METRIC_INNER_PRODUCT)
+        return index
+
+    def set_nprobe(self, index, nprobe: int = None):
+        if self.index_type == 'flat':
+            return
+        ps = faiss.GpuParameterSpace() if self.use_cuda else faiss.ParameterSpace()
+        ps.set_index_parameter(index, 'nprobe', self.nprobe if nprobe is None else nprobe)
+
+    def _exact_search(
+        self, 
+        head_idx: int, 
+        queries: torch.FloatTensor,  # (n_queries, dim)
+        topk: int, 
+        batch_size: int = 1000000) -> torch.LongTensor:  # (n_queries, topk)
+        scores, indices = None, None
+        for b in range(0, self.size, batch_size):
+            keys = self.dequantize(
+                self.keys[head_idx, b:b + batch_size], 
+                self.key_scales[head_idx, b:b + batch_size] if self.is_quantized else None)
+            _scores, _indices = torch.topk(queries @ keys.T, min(topk, keys.size(0)), dim=-1)
+            if scores is not None:  # merge with the results of previous batches
+                _scores, _indices = torch.cat([scores, _scores], -1), torch.cat([indices, _indices + b], -1)
+                _scores, order = torch.topk(_scores, topk, dim=-1)
+                _indices = torch.gather(_indices, 1, order)
+            scores, indices = _scores, _indices
+        return indices
+
+    def tune_nprobe(self, target_recall: float, topk: int, n_queries: int = 256) -> List[int]:
+        # smallest power-of-two nprobe (per head) whose recall@topk against exact search reaches target_recall,
+        # using keys sampled from the dstore as held-out queries
+        assert self.index_type == 'ivfpq' and self.move_dstore_to_mem, 'tuning needs ivfpq indices and the dstore in memory'
+        sample = torch.randperm(self.size)[:n_queries]
+        nprobes = []
+        for h in range(self.n_heads):
+            max_nprobe = self.nlists[h]  # as loaded, whatever it was built with
+            if self.use_cuda:  # limit of faiss gpu ivf search
+                max_nprobe = min(max_nprobe, 2048)
+            queries = self._gather(self.keys, self.key_scales, h, sample)  # (n_queries, dim)
+            exact = self._exact_search(h, queries, topk=topk).numpy()
+            nprobe = 1
+            while True:
+                self.set_nprobe(self.indices[h], nprobe)
+                approx = self.indices[h].search(np.ascontiguousarray(queries.numpy()), topk)[1]
+                recall = np.mean([len(np.intersect1d(a, e)) / len(e) for a, e in zip(approx, exact)])
+                if recall >= target_recall or nprobe >= max_nprobe:
+                    break
+                nprobe = min(nprobe * 2, max_nprobe)
+            logger.info(f'head {h}: nprobe {nprobe} reaches recall@{topk} {recall:.3f}')
+            nprobes.append(nprobe)
+        return nprobes
+
     def build_index(self, batch_size: int):
         self.indices = []
+        if self.use_torch_search:  # the memmap is the index
+            self.keys.flush()
+            return
+        self._madvise('MADV_SEQUENTIAL', self.keys)  # keys are read front to back when adding
+        self.nlists = []
         for h in range(self.n_heads):
             index_name = self.get_index_path(head_idx=h)
-            index = faiss.IndexFlatIP(self.dimension)
+            index = self.create_index()
             self.indices.append(index)
+            if self.index_type != 'flat':
+                self.nlists.append(faiss.extract_index_ivf(index).nlist)
             #index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)  # TODO: multi-gpu
             
             keys_one_head = self.keys[h][:self.cur_idx]  # remove unused slots
-            if not index.is_trained:  # use all keys for training
-                index.train(keys_one_head.astype(np.float32))
+            scales_one_head = self.key_scales[h][:self.cur_idx] if self.is_quantized else None
+            def to_float(b: int, e: int) -> np.ndarray:
+                # head slices of the memmap are contiguous, so fp32 keys are passed to faiss without any copy
+                if scales_one_head is None:
+                    return np.ascontiguousarray(keys_one_head[b:e], dtype=np.float32)
+                return keys_one_head[b:e].astype(np.float32) * scales_one_head[b:e, None].astype(np.float32)
+            if not index.is_trained:  # use all keys for training (faiss subsamples them for ivf clustering)
+                index.train(to_float(0, len(keys_one_head)))
             for b in tqdm(range(0, len(keys_one_head), batch_size), desc='index adding'):
-                batch = keys_one_head[b:b + batch_size].copy()
-                index.add(torch.tensor(batch.astype(np.float32)))
+                index.add(to_float(b, b + batch_size))
             
             faiss.write_index(index, f'{index_name}')
+        self._madvise('MADV_RANDOM', self.keys)
     
+    def _load_to_mem(self, arr: np.ndarray, pad: int = 0, token_major: bool = False) -> torch.Tensor:
+        # a single copy from the memmap, followed by `pad` zero rows so that StridedTensor doesn't need to extend it
+        size = self.size
+        if token_major:  # (n_heads, size, ...) -> (size, n_heads, ...)
+            arr = arr.swapaxes(0, 1)
+        buf = np.zeros((size + pad,) + arr.shape[1:], dtype=arr.dtype)  # zeroed lazily by the OS
+        buf[:size] = arr
+        return torch.from_numpy(buf)
+
     def load_index(self, build_offset: bool = False):
+        # build start/end offsets of each id (assuming ids are consecutive and start with 0)
+        if build_offset:
+            assert self.move_dstore_to_mem, 'strided lookup requires the dstore in memory'
+            start_offsets, end_offsets, consecutive = compute_offsets(np.asarray(self.ids))
+            if not consecutive:
+                raise ValueError('ids are not consecutive')
+            self.start_offsets = torch.from_numpy(start_offsets).to(self.device)
+            self.end_offsets = torch.from_numpy(end_offsets).to(self.device)
+            self.lengths = self.end_offsets - self.start_offsets
+        # the max stride of StridedTensor
+        pad = int((end_offsets - start_offsets).max()) if build_offset and len(start_offsets) else 0
+
         # move dstore
         if self.move_dstore_to_mem:
             start = time.time()
-            self.keys = torch.from_numpy(self.keys[:])
-            self.values = torch.from_numpy(self.values[:])
+            self._madvise('MADV_SEQUENTIAL', self.keys, self.values)  # the whole file is copied once
+            # keys and values are kept token-major (n_tokens, n_heads, dim_per_head) for StridedTensor,
+            # and self.keys/self.values are head-major views of the same memory
+            keys = self._load_to_mem(self.keys, pad=pad, token_major=True)
+            values = self._load_to_mem(self.values, pad=pad, token_major=True)
+            self.keys = keys[:self.size].permute(1, 0, 2)
+            self.values = values[:self.size].permute(1, 0, 2)
+            if self.is_quantized:  # (n_tokens, n_heads) buffers and (n_heads, n_tokens) views like keys/values
+                key_scales = self._load_to_mem(self.key_scales, pad=pad, token_major=True)
+                value_scales = self._load_to_mem(self.value_scales, pad=pad, token_major=True)
+                self.key_scales, self.value_scales = key_scales[:self.size].t(), value_scales[:self.size].t()
             if self.tokens is not None:
-                self.tokens = torch.from_numpy(self.tokens[:])
-                self.ids = torch.from_numpy(self.ids[:])
-                self.positions = torch.from_numpy(self.positions[:]).long()
+                tokens = self._load_to_mem(self.tokens, pad=pad)
+                ids = self._load_to_mem(self.ids, pad=pad)
+                positions = self._load_to_mem(self.positions, pad=pad).long()
+                self.tokens, self.ids, self.positions = tokens[:self.size], ids[:self.size], positions[:self.size]
             # TODO: move to gpu
             #self.keys = self.keys.to(self.device)
             #self.values = self.values.to(self.device)
             logger.info('Moving to memory took {} s'.format(time.time() - start))
         
-        # build start/end offsets of each id (assuming ids are consecutive and start with 0)
         if build_offset:
-            self.start_offsets = []  # inclusive
-            self.end_offsets = []  # exclusive
-            prev_id = -1
-            for i, _id in enumerate(self.ids):
-                if _id == prev_id + 1:  # new id
-                    if len(self.start_offsets):  # not the first
-                        self.end_offsets.append(i)
-                    self.start_offsets.append(i)
-                    prev_id = _id
-                elif _id == prev_id:
-                    pass
-                else:
-                    raise ValueError('ids are not consecutive')
-            self.end_offsets.append(len(self.ids))
-            assert len(self.start_offsets) == len(self.end_offsets)
-            self.start_offsets = torch.tensor(self.start_offsets).to(self.device)
-            self.end_offsets = torch.tensor(self.end_offsets).to(self.device)
-            self.lengths = self.end_offsets - self.start_offsets
-
-            # build strided tensor
+            # build strided tensor (over the padded buffers)
             # (n_tokens, n_heads, dim_per_head)
-            self.keys_strided = StridedTensor(self.keys.permute(1, 0, 2).contiguous(), self.lengths)
+            self.keys_strided = StridedTensor(keys, self.lengths)
             # (n_tokens, n_heads, dim_per_head)
-            self.values_strided = StridedTensor(self.values.permute(1, 0, 2).contiguous(), self.lengths)
+            self.values_strided = StridedTensor(values, self.lengths)
+            self.key_scales_strided = self.value_scales_strided = None
+            if self.is_quantized:  # (n_tokens, n_heads)
+                self.key_scales_strided = StridedTensor(key_scales, self.lengths)
+                self.value_scales_strided = StridedTensor(value_scales, self.lengths)
             if self.tokens is not None and self.ids is not None:
-                self.tokens_strided = StridedTensor(self.tokens, self.lengths)
-                self.ids_strided = StridedTensor(self.ids, self.lengths)
-                self.positions_strided = StridedTensor(self.positions, self.lengths)
+                self.tokens_strided = StridedTensor(tokens, self.lengths)
+                self.ids_strided = StridedTensor(ids, self.lengths)
+                self.positions_strided = StridedTensor(positions, self.lengths)
 
         # load index
         self.indices = []
-        res = faiss.StandardGpuResources()
+        if self.use_torch_search:  # search directly on keys, which are moved to the target device
+            start = time.time()
+            # the in-memory keys are head-major views of token-major buffers (for StridedTensor);
+            # the device copy is made head-major contiguous so that each head's matmul reads one dense block
+            self.keys = self.keys.to(self.device, memory_format=torch.contiguous_format) if self.use_cuda else self.keys
+            self.values = self.values.to(self.device)
+            if self.tokens is not None:
+                self.tokens = self.tokens.to(self.device)
+                self.ids = self.ids.to(self.device)
+            logger.info(f'Moving dstore to {self.device} took {time.time() - start} s')
+            return
+        # each head gets its own gpu resources and cuda stream
+        # so that searches issued from different threads overlap on the gpu
+        self._gpu_resources = []
+        self.nlists: List[int] = []  # number of inverted lists per head (read on cpu since gpu indices are not IndexIVF)
+        self._search_streams = [torch.cuda.Stream(device=self.device) for _ in range(self.n_heads)] if self.use_cuda else []
         start = time.time()
         for h in range(self.n_heads):
             index_name = self.get_index_path(head_idx=h)
             cpu_index = faiss.read_index(index_name, faiss.IO_FLAG_ONDISK_SAME_DIR)
+            if self.index_type != 'flat':
+                self.nlists.append(faiss.extract_index_ivf(cpu_index).nlist)
             if self.use_cuda:  # move index to gpu
-                start = time.time()
+                res = faiss.StandardGpuResources()
+                # the default pool is a fraction of the gpu memory per resource, which adds up over heads
+                res.setTempMemory(self.gpu_temp_memory)
+                self._gpu_resources.append(res)
                 gpu_index = faiss.index_cpu_to_gpu(res, self.device.index, cpu_index)
             else:
                 gpu_index = cpu_index
+            self.set_nprobe(gpu_index)
             self.indices.append(gpu_index)
+        # faiss releases the GIL during search, so a thread per head is enough to overlap them
+        self._search_pool = ThreadPoolExecutor(max_workers=self.n_heads) if self.use_cuda and self.n_heads > 1 else None
         logger.info(f'Loading index took {time.time() - start} s')
 
+    def _search_heads(
+        self,
+        queries: torch.FloatTensor,  # (n_heads, batch_size, dim)
+        topk: int,
+        head_idxs: List[int]) -> torch.LongTensor:  # (len(head_idxs), batch_size, topk)
+        if self.use_torch_search:
+            return self._torch_search(queries[head_idxs], topk=topk, head_idxs=head_idxs)[1]
+        if not self.use_cuda:  # cpu indices: a single d2h copy of the queries and a single h2d copy of the results
+            queries = queries.cpu().numpy()
+            indices = [self.indices[h].search(np.ascontiguousarray(queries[h]), topk)[1] for h in head_idxs]
+            return torch.from_numpy(np.stack(indices, 0)).to(self.keys.device)
+
+        # gpu indices take and return cuda tensors (faiss.contrib.torch_utils), so nothing goes through the host
+        queries = queries.to(device=self.device, dtype=torch.float32)
+        main_stream = torch.cuda.current_stream(self.device)
+        def search(h: int) -> torch.LongTensor:
+            stream = self._search_streams[h]
+            with torch.cuda.stream(stream):  # faiss runs on the current torch stream
+                stream.wait_stream(main_stream)
+                indices = self.indices[h].search(queries[h].contiguous(), topk)[1]
+            indices.record_stream(main_stream)
+            return indices
+        if self._search_pool is not None and len(head_idxs) > 1:
+            indices = list(self._search_pool.map(search, head_idxs))
+        else:
+            indices = [search(h) for h in head_idxs]
+        for h in head_idxs:
+            main_stream.wait_stream(self._search_streams[h])
+        return torch.stack(indices, 0).to(self.keys.device)
+
+    def _torch_search(
+        self,
+        queries: torch.FloatTensor,  # (n_search_heads, batch_size, dim)
+        topk: int,
+        head_idxs: List[int]) -> Tuple[torch.FloatTensor, torch.LongTensor]:  # (n_search_heads, batch_size, topk) * 2
+        # (n_search_heads, size, dim) a view for all heads or a run of consecutive heads (e.g., a single head),
+        # indexing with a list would copy the whole key block of the heads on every search
+        h0 = head_idxs[0]
+        if list(head_idxs) == list(range(h0, h0 + len(head_idxs))):
+            keys = self.keys.narrow(0, h0, len(head_idxs))
+        else:
+            keys = self.keys[head_idxs]
+        queries = queries.to(device=keys.device, dtype=keys.dtype)
+        scores = torch.bmm(queries, keys.transpose(1, 2))  # (n_search_heads, batch_size, size)
+        scores, indices = torch.topk(scores, topk, dim=-1, sorted=True)
+        return scores, indices
+
     def _get_knns_single_head(
         self,
         ret_head_idx: int = None,  # head on which to perform knn retrieval
@@ -271,42 +633,66 @@ class MemTransDatastore(object):
         return_indices: bool = False):
         
         if indices is None:  # retreival
-            index = self.indices[ret_head_idx]
-            # TODO: add torch tensor (GPU) support
-            indices = index.search(np.ascontiguousarray(queries[ret_head_idx].cpu().numpy()), topk)[1]  # (batch_size, topk)
-            indices = torch.from_numpy(indices).to(self.keys.device).unsqueeze(1)  # (batch_size, 1 (n_ctxs), topk)
+            indices = self._search_heads(queries, topk=topk, head_idxs=[ret_head_idx])[0]  # (batch_size, topk)
+            indices = indices.unsqueeze(1)  # (batch_size, 1 (n_ctxs), topk)
         if return_indices:
             return indices
 
         # select
-        ret_k = self.keys[select_head_idx][indices]  # (batch_size, n_ctxs, topk, dim)
-        ret_v = self.values[select_head_idx][indices]  # (batch_size, n_ctxs, topk, dim)
+        ret_k = self._gather(self.keys, self.key_scales, select_head_idx, indices)  # (batch_size, n_ctxs, topk, dim)
+        ret_v = self._gather(self.values, self.value_scales, select_head_idx, indices)  # (batch_size, n_ctxs, topk, dim)
         ret_t = ret_id = None
         if return_all:
             ret_t = self.tokens[indices]  # (batch_size, n_ctxs, topk)
             ret_id = self.ids[indices]  # (batch_size, n_ctxs, topk)
         return ret_k, ret_v, ret_t, ret_id, indices
     
+    @classmethod
+    def _gather(cls, arr: torch.Tensor, scales: torch.Tensor, head_idxs, indices: torch.LongTensor) -> torch.FloatTensor:
+        # only the gathered rows are dequantized (or upcast)
+        return cls.dequantize(arr[head_idxs, indices], scales[head_idxs, indices] if scales is not None else None)
+
+    def _gather_to(
+        self, 
+        arr: torch.Tensor,  # (n_heads, size, dim)
+        scales: torch.Tensor,  # (n_heads, size)
+        indices: torch.LongTensor, 
+        device: torch.device, 
+        buffer_name: str) -> torch.FloatTensor:  # (n_heads, *indices.size(), dim)
+        if arr.is_cuda or device.type != 'cuda':
+            return self._gather(arr, scales, slice(None), indices).to(device)
+        # cpu dstore for a gpu model: gather (in the storage dtype) into a reused pinned buffer
+        # and copy it asynchronously, dequantizing on the gpu
+        flat = indices.reshape(-1)
+        numel = arr.size(0) * flat.numel() * arr.size(2)
+        buffer, event = getattr(self, buffer_name, (None, None))
+        if event is not None:  # the previous copy out of the buffer must be done before overwriting it
+            event.synchronize()
+        if buffer is None or buffer.numel() < numel or buffer.dtype != arr.dtype:
+            buffer = torch.empty(numel, dtype=arr.dtype, pin_memory=True)
+        host = buffer[:numel].view(arr.size(0), flat.numel(), arr.size(2))
+        torch.index_select(arr, 1, flat, out=host)
+        ret = host.to(device, non_blocking=True).view(arr.size(0), *indices.size(), arr.size(2))
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(device))
+        setattr(self, buffer_name, (buffer, event))
+        if scales is not None:
+            scales = scales[:, indices].to(device)
+        return self.dequantize(ret, scales)
+
     def get_knns_by_indices(
         self,
         indices: torch.LongTensor,  # (batch_size, n_ctxs, topk), indices from previous layers
         device: torch.device,
         return_all: bool = False,
     ):
-        ret_ks, ret_vs, ret_ts, ret_ids = [], [], [], []
-        for h in range(self.n_heads):
-            ret_k, ret_v, ret_t, ret_id, _ = self._get_knns_single_head(
-                select_head_idx=h, indices=indices, return_all=return_all)
-            ret_ks.append(ret_k)
-            ret_vs.append(ret_v)
-            ret_ts.append(ret_t)
-            ret_ids.append(ret_id)
-
-        ret_ks = torch.stack(ret_ks, dim=0).to(device)  # (n_heads, batch_size, n_ctxs, topk, dim)
-        ret_vs = torch.stack(ret_vs, dim=0).to(device)  # (n_heads, batch_size, n_ctxs, topk, dim)
-        if return_all:
-            ret_ts = torch.stack(ret_ts, dim=0).to(device)  # (n_heads, batch_size, n_ctxs, topk)
-            ret_ids = torch.stack(ret_ids, dim=0).to(device)  # (n_heads, batch_size, n_ctxs, topk)
+        indices = indices.to(self.keys.device)  # indices might come from a dstore on another device
+        # all heads select with the same indices so a single gather fills the output directly
+        ret_ks = self._gather_to(self.keys, self.key_scales, indices, device, '_pinned_keys')  # (n_heads, batch_size, n_ctxs, topk, dim)
+        ret_vs = self._gather_to(self.values, self.value_scales, indices, device, '_pinned_values')  # (n_heads, batch_size, n_ctxs, topk, dim)
+        if return_all:  # shared by all heads
+            ret_ts = self.tokens[indices].unsqueeze(0).expand(self.n_heads, *indices.size()).to(device)  # (n_heads, batch_size, n_ctxs, topk)
+            ret_ids = self.ids[indices].unsqueeze(0).expand(self.n_heads, *indices.size()).to(device)  # (n_heads, batch_size, n_ctxs, topk)
             return ret_ks, ret_vs, ret_ts, ret_ids
         return ret_ks, ret_vs, None, None
 
@@ -335,13 +721,17 @@ class MemTransDatastore(object):
         nh, bs, sl, dim = all_queries.size()
 
         for only_use_head_idx in only_use_head_idxs:
-            index = self.indices[only_use_head_idx]
-
             _queries = all_queries[only_use_head_idx].contiguous()  # (batch_size, seq_len, dim)
-            _queries_to_faiss = _queries.view(-1, dim).cpu().numpy()  # (batch_size * seq_len, dim) TODO: add torch tensor (GPU) support
-            _scores, _indices = index.search(_queries_to_faiss, topk)  # (batch_size * seq_len, topk) * 2
-            _scores = torch.from_numpy(_scores).to(ori_device).view(bs, sl, topk)  # (batch_size, seq_len, topk)
-            _indices = torch.from_numpy(_indices).to(self.ids.device).view(bs, sl, topk)  # (batch_size, seq_len, topk)
+            if self.use_torch_search:
+                _scores, _indices = self._torch_search(_queries.view(1, -1, dim), topk, head_idxs=[only_use_head_idx])
+                _scores, _indices = _scores[0], _indices[0]  # (batch_size * seq_len, topk) * 2
+            else:
+                index = self.indices[only_use_head_idx]
+                _queries_to_faiss = _queries.view(-1, dim).cpu().numpy()  # (batch_size * seq_len, dim) TODO: add torch tensor (GPU) support
+                _scores, _indices = index.search(_queries_to_faiss, topk)  # (batch_size * seq_len, topk) * 2
+                _scores, _indices = torch.from_numpy(_scores), torch.from_numpy(_indices)
+            _scores = _scores.to(ori_device).view(bs, sl, topk)  # (batch_size, seq_len, topk)
+            _indices = _indices.to(self.ids.device).view(bs, sl, topk)  # (batch_size, seq_len, topk)
             _ret_ids = self.ids[_indices].to(ori_device)  # (batch_size, seq_len, topk)
             _ids = []  # list of ids for retrieval (i_batch_size, final_topk)
             #_ctxs: List[List[int]] = fixed_retrieval.get_ctxs(batch_size=bs)
@@ -431,32 +821,29 @@ class MemTransDatastore(object):
                 return ret_ks, ret_vs, ret_ts, ret_ids, indices
             return ret_ks, ret_vs, None, None, indices
 
-        ret_ks, ret_vs, ret_ts, ret_ids = [], [], [], []
-
         if only_use_head_idx == -1:  # different heads retrieve separately
-            for h in range(self.n_heads):
-                ret_k, ret_v, ret_t, ret_id, indices = self._get_knns_single_head(
-                    ret_head_idx=h, select_head_idx=h, queries=queries, topk=topk, return_all=return_all)
-                ret_ks.append(ret_k)
-                ret_vs.append(ret_v)
-                ret_ts.append(ret_t)
-                ret_ids.append(ret_id)
+            indices = self._search_heads(queries, topk=topk, head_idxs=list(range(self.n_heads))).unsqueeze(2)  # (n_heads, batch_size, 1 (n_ctxs), topk)
+            # gather all heads with a single advanced indexing op
+            head_idxs = torch.arange(self.n_heads, device=indices.device).view(-1, 1, 1, 1)
+            ret_ks = self._gather(self.keys, self.key_scales, head_idxs, indices)  # (n_heads, batch_size, n_ctxs, topk, dim)
+            ret_vs = self._gather(self.values, self.value_scales, head_idxs, indices)  # (n_heads, batch_size, n_ctxs, topk, dim)
+            if return_all:
+                ret_ts = self.tokens[indices]  # (n_heads, batch_size, n_ctxs, topk)
+                ret_ids = self.ids[indices]  # (n_heads, batch_size, n_ctxs, topk)
+            indices = indices[-1]  # (batch_size, n_ctxs, topk) indices of the last head
         else:
-            indices = self._get_knns_single_head(
-                ret_head_idx=only_use_head_idx, queries=queries, topk=topk, return_indices=True)
-            for h in range(self.n_heads):
-                ret_k, ret_v, ret_t, ret_id, _ = self._get_knns_single_head(
-                    select_head_idx=h, indices=indices, return_all=return_all)
-                ret_ks.append(ret_k)
-                ret_vs.append(ret_v)
-                ret_ts.append(ret_t)
-                ret_ids.append(ret_id)
-
-        ret_ks = torch.stack(ret_ks, dim=0).to(ori_device)  # (n_heads, batch_size, n_ctxs, topk, dim)
-        ret_vs = torch.stack(ret_vs, dim=0).to(ori_device)  # (n_heads, batch_size, n_ctxs, topk, dim)
+            indices = self._search_heads(queries, topk=topk, head_idxs=[only_use_head_idx])[0].unsqueeze(1)  # (batch_size, 1 (n_ctxs), topk)
+            ret_ks = self._gather(self.keys, self.key_scales, slice(None), indices)  # (n_heads, batch_size, n_ctxs, topk, dim)
+            ret_vs = self._gather(self.values, self.value_scales, slice(None), indices)  # (n_heads, batch_size, n_ctxs, topk, dim)
+            if return_all:  # shared by all heads
+                ret_ts = self.tokens[indices].unsqueeze(0).expand(self.n_heads, *indices.size())  # (n_heads, batch_size, n_ctxs, topk)
+                ret_ids = self.ids[indices].unsqueeze(0).expand(self.n_heads, *indices.size())  # (n_heads, batch_size, n_ctxs, topk)
+
+        ret_ks = ret_ks.to(device=ori_device, dtype=torch.float32)
+        ret_vs = ret_vs.to(device=ori_device, dtype=torch.float32)
         if return_all:
-            ret_ts = torch.stack(ret_ts, dim=0).to(ori_device)  # (n_heads, batch_size, n_ctxs, topk)
-            ret_ids = torch.stack(ret_ids, dim=0).to(ori_device)  # (n_heads, batch_size, n_ctxs, topk)
+            ret_ts = ret_ts.to(ori_device)
+            ret_ids = ret_ids.to(ori_device)
             return ret_ks, ret_vs, ret_ts, ret_ids, indices
         return ret_ks, ret_vs, None, None, indices
     
@@ -523,8 +910,13 @@ class MemTransDatastore(object):
             batch_size, n_cand = ids.size()
         ids = ids.view(-1)  # (batch_size) or (batch_size * n_cand)
 
-        ret_ks = self.keys_strided.lookup(ids, output='padded')[0]  # (batch_size, seq_len, n_heads, dim)
-        ret_vs = self.values_strided.lookup(ids, output='padded')[0]  # (batch_size, seq_len, n_heads, dim)
+        # (batch_size, seq_len, n_heads, dim) * 2
+        ret_ks = self.dequantize(
+            self.keys_strided.lookup(ids, output='padded')[0], 
+            self.key_scales_strided.lookup(ids, output='padded')[0] if self.is_quantized else None)
+        ret_vs = self.dequantize(
+            self.values_strided.lookup(ids, output='padded')[0], 
+            self.value_scales_strided.lookup(ids, output='padded')[0] if self.is_quantized else None)
         indices, mask = self.positions_strided.lookup(ids, output='padded')  # (batch_size, seq_len) * 2
         if return_all:
             ret_ts = self.tokens_strided.lookup(ids, output='padded')[0]  # (batch_size, seq_len)
@@ -557,8 +949,9 @@ class MemTransDatastore(object):
         ret_ks = ret_ks.permute(2, 0, 1, 3)  # (n_heads, batch_size, topk, dim)
         ret_vs = ret_vs.permute(2, 0, 1, 3)  # (n_heads, batch_size, topk, dim)
         if return_all:
-            ret_ts = ret_ts.unsqueeze(0).repeat(self.n_heads, 1, 1)  # (n_heads, batch_size, topk)
-            ret_ids = ret_ids.unsqueeze(0).repeat(self.n_heads, 1, 1)  # (n_heads, batch_size, topk)
+            # shared by all heads so use stride-0 views instead of copies (consumers only read them)
+            ret_ts = ret_ts.unsqueeze(0).expand(self.n_heads, -1, -1)  # (n_heads, batch_size, topk)
+            ret_ids = ret_ids.unsqueeze(0).expand(self.n_heads, -1, -1)  # (n_heads, batch_size, topk)
         
         if has_cand:
             ret_ks = ret_ks.view(*ret_ks.shape[:1], batch_size, n_cand, *ret_ks.shape[2:])  # (n_heads, batch_size, n_cand, topk, dim)
@@ -566,8 +959,8 @@ class MemTransDatastore(object):
             indices = indices.view(batch_size, n_cand, *indices.shape[1:])  # (batch_size, n_cand, topk)
             mask = mask.view(batch_size, n_cand, *mask.shape[1:])  # (batch_size, n_cand, topk)
             if return_all:
-                ret_ts = ret_ts.view(batch_size, n_cand, *ret_ts.shape[1:])  # (batch_size, n_cand, topk)
-                ret_ids = ret_ids.view(batch_size, n_cand, *ret_ids.shape[1:])  # (batch_size, n_cand, topk)
+                ret_ts = ret_ts.view(*ret_ts.shape[:1], batch_size, n_cand, *ret_ts.shape[2:])  # (n_heads, batch_size, n_cand, topk)
+                ret_ids = ret_ids.view(*ret_ids.shape[:1], batch_size, n_cand, *ret_ids.shape[2:])  # (n_heads, batch_size, n_cand, topk)
 
         if return_all:
             return ret_ks, ret_vs, ret_ts, ret_ids, indices, mask
@@ -598,8 +991,8 @@ class RetrievalTracker(object):
         retrieved_id: torch.LongTensor):  # (batch_size, n_heads, topk)
         assert prediction.size(0) == retrieved_token.size(0) == retrieved_id.size(0)
         self.predictions.append(prediction)
-        self.retrieved_tokens.append(retrieved_token)
-        self.retrieved_ids.append(retrieved_id)
+        self.retrieved_tokens.append(retrieved_token.long())  # tokens might be stored in a narrower dtype
+        self.retrieved_ids.append(retrieved_id.long())
     
     def _write(self, text: str):
         if self.handle is None:
@@ -611,10 +1004,9 @@ class RetrievalTracker(object):
         predictions = torch.stack(self.predictions, dim=1)  # (batch_size, seq_len)
     
         # pad with 0
-        max_topk_idx = np.argmax([rt.size(-1) for rt in self.retrieved_tokens])
-        max_topk = self.retrieved_tokens[max_topk_idx].size(-1)
-        self.retrieved_tokens = [torch.zeros_like(self.retrieved_tokens[max_topk_idx]) if rt.size(-1) != max_topk else rt for rt in self.retrieved_tokens]
-        self.retrieved_ids = [torch.zeros_like(self.retrieved_ids[max_topk_idx]) if ri.size(-1) != max_topk else ri for ri in self.retrieved_ids]
+        max_topk = max(rt.size(-1) for rt in self.retrieved_tokens)
+        self.retrieved_tokens = [nn.functional.pad(rt, (0, max_topk - rt.size(-1))) for rt in self.retrieved_tokens]
+        self.retrieved_ids = [nn.functional.pad(ri, (0, max_topk - ri.size(-1))) for ri in self.retrieved_ids]
 
         # pack
         retrieved_tokens = torch.stack(self.retrieved_tokens, dim=1)  # (batch_size, seq_len, n_heads, topk)
@@ -622,13 +1014,16 @@ class RetrievalTracker(object):
         retrieved = torch.stack([retrieved_tokens, retrieved_ids], dim=-1)  # (batch_size, seq_len, n_heads, topk, 2)
         bs, sl, nh, topk = retrieved_tokens.size()
         agg = torch.cat([predictions.unsqueeze(-1), retrieved.flatten(2, 4)], dim=-1)  # (batch_size, seq_len, 1 + n_heads * topk * 2)
+        agg = agg.cpu().numpy()  # a single device-to-host copy
+
+        # the prediction ends before the first eos (or covers all steps)
+        is_eos = agg[:, :, 0] == self.eos_token_id  # (batch_size, seq_len)
+        ends = np.where(is_eos.any(1), is_eos.argmax(1), sl)  # (batch_size)
+        lines = []
         for i in range(bs):
-            for j in range(sl):
-                if agg[i, j, 0].item() == self.eos_token_id:  # end of prediction
-                    break
-                s = agg[i, j].tolist()
-                self._write(' '.join(map(str, s)) + '\n')
-            self._write('\n')
+            lines.extend(' '.join(map(str, row)) + '\n' for row in agg[i, :ends[i]].tolist())
+            lines.append('\n')
+        self._write(''.join(lines))
         
         # clear cache
         self.predictions = []
@@ -674,8 +1069,14 @@ class MemTransAttn(object):
             self.tracker = RetrievalTracker(track_file=track_file, n_heads=dstore.n_heads, topk=topk, eos_token_id=eos_token_id)
         
         self.by_ids = by_ids
-        self.by_ids_cache = None  # cache the retrieved results so following decoding steps do not need to retrieve
+        # cache the retrieved results so following decoding steps do not need to retrieve
+        # (id_offset it was built for, (ret_ks, ret_vs, ret_ts, ret_ids, indices))
+        self.by_ids_cache: Tuple[int, Tuple] = None
         self.id_offset = shard_start  # example idx
+        self._arange_cache: torch.LongTensor = None  # reused by _arange
+        self.kv_buffers: Dict[str, torch.FloatTensor] = {}  # growable self-attn kv caches (see append_to_kv_buffer)
+        self._qkv_weight: Tuple[Tuple, torch.FloatTensor] = None  # (source weights, concatenated q/k/v weight)
+        self.scale = 1.0  # T5 does not scale the dot product (folded into the initialization of q)
         
         self.skip_retrieval_steps = skip_retrieval_steps
         self.accum_retrieval_steps = accum_retrieval_steps
@@ -706,6 +1107,19 @@ class MemTransAttn(object):
     def is_track(self):
         return bool(self.track)
 
+    def get_qkv_weight(self, attn: T5Attention) -> torch.FloatTensor:  # (3 * inner_dim, d_model)
+        # rebuilt when the projection weights are replaced or moved (e.g., model.to)
+        src = tuple((w.data_ptr(), w.dtype, w._version) for w in (attn.q.weight, attn.k.weight, attn.v.weight))
+        if self._qkv_weight is None or self._qkv_weight[0] != src:
+            self._qkv_weight = (src, torch.cat([attn.q.weight, attn.k.weight, attn.v.weight], dim=0).detach())
+        return self._qkv_weight[1]
+
+    def _arange(self, n: int, device: torch.device) -> torch.LongTensor:
+        # slice of a cached arange to avoid allocating (and copying to device) a new one every step
+        if self._arange_cache is None or self._arange_cache.size(0) < n or self._arange_cache.device != device:
+            self._arange_cache = torch.arange(n, device=device)
+        return self._arange_cache[:n]
+
     def save(
         self,
         key_states: torch.FloatTensor,  # (batch_size, n_heads, seq_length, dim_per_head)
@@ -714,12 +1128,12 @@ class MemTransAttn(object):
         bs, _, sl, _ = key_states.size()
 
         # get mask
-        labels, decoder_input_ids = self.dstore.get_labels()  # (batch, seq_length)
+        labels, decoder_input_ids = self.mtac.get_labels()  # (batch, seq_length)
         labels, decoder_input_ids = labels.flatten(0, 1), decoder_input_ids.flatten(0, 1)  # (batch * seq_length)
         mask = labels != -100
 
         # get idx
-        ids = self.id_offset + torch.arange(bs).unsqueeze(-1).repeat(1, sl).flatten(0, 1)  # (batch * seq_length)
+        ids = self.id_offset + self._arange(bs, mask.device).unsqueeze(-1).expand(bs, sl).reshape(-1)  # (batch * seq_length)
         self.id_offset += bs
         
         # remove padding tokens
@@ -868,27 +1282,30 @@ class MemTransAttn(object):
             if indices is not None:
                 if debug:
                     print('use indicies')
-                ret_ks, ret_vs, ret_ts, ret_ids = self.dstore.get_knns_by_indices(indices=indices, device=ori_device, return_all=self.is_track)
+                prefetched = self.mtac.get_prefetched(key_length=key_length, layer_index=self.layer_index)
+                if prefetched is None:
+                    prefetched = self.dstore.get_knns_by_indices(indices=indices, device=ori_device, return_all=self.is_track)
+                ret_ks, ret_vs, ret_ts, ret_ids = prefetched
 
         if not self.cache_indices or indices is None:  # perform retrieval
             if debug:
                 print('use knn')
             if self.by_ids:
-                if self.by_ids_cache:  # use horizontal cache
-                    ret_ks, ret_vs, ret_ts, ret_ids, indices = self.by_ids_cache
+                if self.by_ids_cache is not None and self.by_ids_cache[0] == self.id_offset:  # use horizontal cache
+                    ret_ks, ret_vs, ret_ts, ret_ids, indices = self.by_ids_cache[1]
                 else:  # retrieval by ids
                     if ids is None:
                         if fake_retrieval:
-                            ids = torch.arange(bs).to(ori_device) + self.id_offset
+                            ids = self._arange(bs, ori_device) + self.id_offset
                             # (batch_size, accum) for the i-th example, retrieve i, i + 1, ..., i + accum - 1
-                            ids = ids.unsqueeze(-1) + torch.arange(100).to(ori_device).unsqueeze(0)  # TODO: add argument
+                            ids = ids.unsqueeze(-1) + self._arange(100, ori_device).unsqueeze(0)  # TODO: add argument
                             ids_maks = ids < self.dstore.num_docs  # (batch_size, accum)
                             ids = ids * ids_maks  # out-of-boundary ids are replaced with 0
                         else:
-                            ids = torch.arange(bs).to(ori_device).unsqueeze(-1) + self.id_offset  # (batch_size, 1 (n_ctxs))
+                            ids = self._arange(bs, ori_device).unsqueeze(-1) + self.id_offset  # (batch_size, 1 (n_ctxs))
                     ret_ks, ret_vs, ret_ts, ret_ids, indices, _ = self.dstore.get_knns_by_ids(
                         ids, topk=topk, skip_first_token=self.skip_first_token, return_all=self.is_track)
-                    self.by_ids_cache = (ret_ks, ret_vs, ret_ts, ret_ids, indices)
+                    self.by_ids_cache = (self.id_offset, (ret_ks, ret_vs, ret_ts, ret_ids, indices))
 
                 if fake_retrieval:
                     # save for accumulation
@@ -912,12 +1329,13 @@ class MemTransAttn(object):
                     skip_first_token=self.skip_first_token,
                     return_all=self.is_track)
         
-        if self.cache_indices:  # cache indices
+        if self.cache_indices and self.mtac.get_or_save_indices(key_length=key_length) is None:  # cache indices
             self.mtac.get_or_save_indices(key_length=key_length, indices=indices)
+            self.mtac.prefetch(key_length=key_length, indices=indices, device=ori_device, skip_layer=self.layer_index)
 
         # track retrieval
         if self.is_track:
-            input_ids = self.dstore.get_decoder_input_ids()  # (batch_size, seq_length)
+            input_ids = self.mtac.get_decoder_input_ids()  # (batch_size, seq_length)
             self.tracker.add_single_step_batched(
                 prediction=input_ids.squeeze(-1), 
                 retrieved_token=ret_ts.permute(1, 0, 2, 3).flatten(2, 3), 
@@ -936,27 +1354,100 @@ class MemTransAttn(object):
         key_length: int,
         topk: int,
     ):
+        lengths = (seq_length, real_seq_length, key_length, topk)
+        key_mask = mask  # the caller's mask object (shared by all layers) identifies the step
+        if self.mtac is not None:  # computed by a previous layer at this step
+            position_bias = self.mtac.get_or_save_position_bias(key_mask, lengths)
+            if position_bias is not None:
+                return position_bias
+
         # extend the mask
         if mask is not None:
-            ext_size = mask.shape[:3] + (topk,)
+            # retrieved positions are never masked; pad in place of building (on cpu) and concatenating a zero block
             # (batch_size, n_heads, seq_length, topk + key_length)
-            mask = torch.cat([torch.zeros(*ext_size).to(mask), mask], dim=3)
+            mask = nn.functional.pad(mask, (topk, 0))
         
         # update relative positions
-        position_bias = ori_attn.compute_bias(topk + real_seq_length, topk + key_length)
         # need to truncate because ret_topk > 0
         # (batch_size, n_heads, seq_length, topk + key_length)
-        position_bias = position_bias[:, :, -seq_length:, :]
+        if self.mtac is not None:  # only the rows of the last seq_length positions are built
+            position_bias = self.mtac.relative_position_bias(ori_attn, topk + real_seq_length, topk + key_length, seq_length)
+        else:
+            position_bias = ori_attn.compute_bias(topk + real_seq_length, topk + key_length)
+            position_bias = position_bias[:, :, -seq_length:, :]
         if mask is not None:
             # (batch_size, n_heads, seq_length, topk + key_length)
             position_bias = position_bias + mask
         
+        if self.mtac is not None:
+            self.mtac.get_or_save_position_bias(key_mask, lengths, position_bias=position_bias)
         return position_bias
     
+    @staticmethod
+    def block_softmax(scores: torch.FloatTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        # unnormalized softmax of one block of keys against its own max: (exp(scores - max), max, sum of exp)
+        scores = scores.float()
+        m = scores.amax(-1, keepdim=True)
+        p = (scores - m).exp_()
+        return p, m, p.sum(-1, keepdim=True)
+
+    def blockwise_attn(
+        self, 
+        ori_attn: T5Attention, 
+        _scores: torch.FloatTensor,  # (batch_size, n_heads, seq_length, n_ctxs * topk)
+        scores: torch.FloatTensor,  # (batch_size, n_heads, seq_length, key_length)
+        ret_vs: torch.FloatTensor,  # (batch_size, n_heads, seq_length, n_ctxs * topk, dim_per_head)
+        value_states: torch.FloatTensor,  # (batch_size, n_heads, key_length, dim_per_head)
+    ) -> torch.FloatTensor:  # (batch_size, n_heads, seq_length, dim_per_head)
+        # online softmax over the retrieved and the local block without concatenating them:
+        # each block is exponentiated against its own max, rescaled in place to the joint max,
+        # and the normalizer is applied once to the output instead of to the weights
+        bs, nh, sl, kl = scores.size()
+        d = value_states.size(-1)
+        dtype = value_states.dtype
+        _attn_weights, m_ret, l_ret = self.block_softmax(_scores)
+        attn_weights_local, m_local, l_local = self.block_softmax(scores)
+        m = torch.maximum(m_ret, m_local)
+        c_ret, c_local = (m_ret - m).exp_(), (m_local - m).exp_()
+        norm = (l_ret * c_ret + l_local * c_local).to(dtype)  # (batch_size, n_heads, seq_length, 1)
+        _attn_weights = _attn_weights.mul_(c_ret).to(dtype)
+        attn_weights_local = attn_weights_local.mul_(c_local).to(dtype)
+        # dropout is elementwise so it commutes with the normalization
+        _attn_weights = nn.functional.dropout(_attn_weights, p=ori_attn.dropout, training=ori_attn.training)
+        attn_weights_local = nn.functional.dropout(attn_weights_local, p=ori_attn.dropout, training=ori_attn.training)
+
+        # the retrieved part is a batched gemv per query, which is then used as the accumulator
+        # of the local gemm so the sum happens in the gemm epilogue instead of a separate kernel
+        attn_output = torch.matmul(_attn_weights.unsqueeze(-2), ret_vs).squeeze(-2)
+        attn_output = torch.baddbmm(
+            attn_output.reshape(bs * nh, sl, d), 
+            attn_weights_local.reshape(bs * nh, sl, kl), 
+            value_states.reshape(bs * nh, kl, d)).view(bs, nh, sl, d)
+        return attn_output.div_(norm)
+
+    def scaled(self, query_states: torch.FloatTensor) -> torch.FloatTensor:
+        # scale the (smaller) queries instead of the scores, a no-op for T5
+        return query_states if self.scale == 1.0 else query_states * self.scale
+
+    @staticmethod
+    def biased_scores(
+        query_states: torch.FloatTensor,  # (batch_size, n_heads, seq_length, dim_per_head)
+        key_states: torch.FloatTensor,  # (batch_size, n_heads, key_length, dim_per_head)
+        bias: torch.FloatTensor,  # broadcastable to (batch_size, n_heads, seq_length, key_length)
+        scale: float = 1.0,
+    ) -> torch.FloatTensor:  # (batch_size, n_heads, seq_length, key_length)
+        # scale * q @ k^T + bias in one baddbmm so the scale and the bias are applied in the gemm epilogue
+        bs, nh, sl, d = query_states.size()
+        kl = key_states.size(2)
+        bias = bias.to(query_states.dtype).expand(bs, nh, sl, kl).reshape(bs * nh, sl, kl)
+        scores = torch.baddbmm(
+            bias, query_states.reshape(bs * nh, sl, d), key_states.reshape(bs * nh, kl, d).transpose(1, 2), alpha=scale)
+        return scores.view(bs, nh, sl, kl)
+
     @staticmethod
     def unshape(states):
         bs, nh, sl, d = states.size()
-        return states.transpose(1, 2).contiguous().view(bs, sl, -1)
+        return states.transpose(1, 2).reshape(bs, sl, -1)  # only copies when needed (not for a single decoding step)
     
     def init_position_bias(
         self, 
@@ -967,8 +1458,13 @@ class MemTransAttn(object):
         key_length: int,
         seq_length: int,
         device: torch.device):
+        new_self = self
         self = ori_attn
-        if not self.has_relative_attention_bias:
+        if self.has_relative_attention_bias and new_self.mtac is not None:
+            # (1, n_heads, seq_length, key_length) only the rows that are needed
+            n_rows = seq_length if past_key_value is not None else real_seq_length
+            position_bias = new_self.mtac.relative_position_bias(self, real_seq_length, key_length, n_rows)
+        elif not self.has_relative_attention_bias:
             position_bias = torch.zeros(
                 (1, self.n_heads, real_seq_length, key_length), device=device, dtype=ori_attn.dtype
             )
@@ -1004,17 +1500,13 @@ class MemTransAttn(object):
         self = ori_attn
         
         # === original attn code (start) ===
-        # compute scores
-        scores = torch.matmul(
-            query_states, key_states.transpose(3, 2)
-        )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
-        
         if position_bias is None:
             position_bias = new_self.init_position_bias(
                 ori_attn, past_key_value, mask, 
-                real_seq_length=real_seq_length, key_length=key_length, seq_length=query_states.size(2), device=scores.device)
+                real_seq_length=real_seq_length, key_length=key_length, seq_length=query_states.size(2), device=query_states.device)
 
-        scores += position_bias
+        # compute scores with the bias added in the gemm
+        scores = new_self.biased_scores(query_states, key_states, position_bias, new_self.scale)  # (batch_size, n_heads, seq_length, key_length)
         attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(
             scores
         )  # (batch_size, n_heads, seq_length, key_length)
@@ -1043,7 +1535,8 @@ class MemTransAttn(object):
         mask: torch.FloatTensor,  # (batch_size, n_heads, seq_length, key_length)
         layer_head_mask,
         real_seq_length: int,
-        key_length: int
+        key_length: int,
+        output_attentions: bool = False,
     ): 
         if layer_head_mask is not None:
             raise NotImplementedError()
@@ -1071,34 +1564,42 @@ class MemTransAttn(object):
 
             assert sl == kl == real_seq_length == key_length, 'should be in eval mode'
 
-            # compute the original scores over local context
-            # (batch_size, n_heads, seq_length, key_length)
-            scores = torch.matmul(query_states, key_states.transpose(3, 2))
-
-            # compute the extended scores over the retrieved context
-            # (batch_size, n_heads, seq_length, n_ctxs, topk)
-            _scores = torch.einsum("bnqd,bnqckd->bnqck", query_states, ret_ks)
-
-            # apply bias
             # (batch_size, n_heads, seq_length, topk + key_length)
             position_bias = self.update_mask_and_position_bias(
                 ori_attn, mask, seq_length=sl, real_seq_length=real_seq_length, key_length=key_length, topk=topk)
-            scores += position_bias[:, :, :, -kl:]
-            _scores += position_bias[:, :, :, None, :topk]
-
-            # combine scores
-            # (batch_size, n_heads, seq_length, n_ctxs * topk + key_length)
-            scores = torch.cat([_scores.flatten(3, 4), scores], dim=-1)
 
-            # compute attn distribution
-            # (batch_size, n_heads, seq_length, n_ctxs * topk + key_length)
-            attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
-            attn_weights = nn.functional.dropout(attn_weights, p=ori_attn.dropout, training=ori_attn.training)
+            # compute the original scores over local context with the bias applied
+            # (batch_size, n_heads, seq_length, key_length)
+            scores = self.biased_scores(query_states, key_states, position_bias[:, :, :, -kl:], self.scale)
 
-            # compute output
-            # (batch_size, n_heads, seq_length, dim_per_head)
-            attn_output = torch.matmul(attn_weights[:, :, :, -kl:], value_states)
-            attn_output += torch.einsum("bnqk,bnqkd->bnqd", attn_weights[:, :, :, :n_ctxs * topk], ret_vs.flatten(3, 4))
+            # compute the extended scores over the retrieved context
+            # (batch_size, n_heads, seq_length, n_ctxs, topk)
+            _scores = torch.einsum("bnqd,bnqckd->bnqck", self.scaled(query_states), ret_ks)
+            _scores += position_bias[:, :, :, None, :topk]
+            _scores = _scores.flatten(3, 4)  # (batch_size, n_heads, seq_length, n_ctxs * topk)
+
+            if output_attentions:  # materialize the full distribution
+                # combine scores
+                # (batch_size, n_heads, seq_length, n_ctxs * topk + key_length)
+                scores = torch.cat([_scores, scores], dim=-1)
+
+                # compute attn distribution
+                # (batch_size, n_heads, seq_length, n_ctxs * topk + key_length)
+                attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
+                attn_weights = nn.functional.dropout(attn_weights, p=ori_attn.dropout, training=ori_attn.training)
+                _attn_weights, attn_weights_local = attn_weights[:, :, :, :n_ctxs * topk], attn_weights[:, :, :, -kl:]
+
+                # compute output
+                # (batch_size, n_heads, seq_length, dim_per_head)
+                attn_output = torch.matmul(_attn_weights.unsqueeze(-2), ret_vs.flatten(3, 4)).squeeze(-2)
+                attn_output = torch.baddbmm(
+                    attn_output.reshape(bs * nh, sl, d), 
+                    attn_weights_local.reshape(bs * nh, sl, kl), 
+                    value_states.reshape(bs * nh, kl, d)).view(bs, nh, sl, d)
+            else:
+                # (batch_size, n_heads, seq_length, dim_per_head)
+                attn_output = self.blockwise_attn(ori_attn, _scores, scores, ret_vs.flatten(3, 4), value_states)
+                attn_weights = None
             attn_output = self.unshape(attn_output)  # (batch_size, seq_length, dim)
             attn_output = ori_attn.o(attn_output)
         
@@ -1109,6 +1610,36 @@ class MemTransAttn(object):
 
             ret_ks, ret_vs = ret_ks.flatten(3, 4), ret_vs.flatten(3, 4)  # (batch_size, n_heads, seq_length, n_ctxs * topk, dim_per_head) * 2
 
+            # apply bias
+            # (batch_size, n_heads, seq_length, topk + key_length)
+            position_bias = self.update_mask_and_position_bias(
+                ori_attn, mask, seq_length=sl, real_seq_length=real_seq_length, key_length=key_length, topk=topk)
+
+            if not output_attentions:
+                # single query: two gemvs over the retrieved and the local keys as they are,
+                # so the kv cache is not copied into a concatenated tensor at every step
+                ret_ks, ret_vs = ret_ks.to(query_states.dtype), ret_vs.to(query_states.dtype)
+                # (batch_size, n_heads, seq_length, n_ctxs * topk)
+                ret_bias = position_bias[:, :, :, None, :topk].expand(-1, -1, -1, n_ctxs, -1).flatten(3, 4)
+                local_bias = position_bias[:, :, :, -kl:]  # (batch_size, n_heads, seq_length, key_length)
+                if self.add_after_first and key_length > 1:
+                    # layout [k0, ret, k1:] with the bias applied by column as in the concatenated path below:
+                    # the first key joins the (small) retrieved block and the rest of the cache is a view
+                    ret_ks = torch.cat([key_states[:, :, None, :1].to(ret_ks.dtype), ret_ks], dim=3)
+                    ret_vs = torch.cat([value_states[:, :, None, :1].to(ret_vs.dtype), ret_vs], dim=3)
+                    ret_bias = torch.cat([ret_bias, local_bias[..., :1]], dim=-1)
+                    key_states, value_states, local_bias = key_states[:, :, 1:], value_states[:, :, 1:], local_bias[..., 1:]
+                # (batch_size, n_heads, seq_length, n_ret) where n_ret is n_ctxs * topk (+ 1)
+                _scores = torch.matmul(ret_ks, self.scaled(query_states).unsqueeze(-1)).squeeze(-1) + ret_bias
+                # (batch_size, n_heads, seq_length, n_local)
+                scores = self.biased_scores(query_states, key_states, local_bias, self.scale)
+                # (batch_size, n_heads, seq_length, dim_per_head)
+                attn_output = self.blockwise_attn(ori_attn, _scores, scores, ret_vs, value_states)
+                attn_output = self.unshape(attn_output)  # (batch_size, seq_length, dim)
+                attn_output = ori_attn.o(attn_output)
+                return None, attn_output
+
+            # only reached when the full attention distribution is requested:
             # prepend retrieved keys and values
             # (batch_size, n_heads, n_ctxs * topk + key_length, dim_per_head)
             if self.add_after_first and key_length > 1:  # always need to prepend for the first position
@@ -1120,12 +1651,7 @@ class MemTransAttn(object):
 
             # compute attn scores
             # (batch_size, n_heads, seq_length, n_ctxs * topk + key_length)
-            scores = torch.matmul(query_states, key_states.transpose(3, 2))
-
-            # apply bias
-            # (batch_size, n_heads, seq_length, topk + key_length)
-            position_bias = self.update_mask_and_position_bias(
-                ori_attn, mask, seq_length=sl, real_seq_length=real_seq_length, key_length=key_length, topk=topk)
+            scores = torch.matmul(self.scaled(query_states), key_states.transpose(3, 2))
             _scores = scores[:, :, :, :n_ctxs * topk].view(bs, nh, sl, n_ctxs, topk)  # (batch_size, n_heads, seq_length, n_ctxs, topk)
             _scores = (_scores + position_bias[:, :, :, None, :topk]).flatten(3, 4)  # (batch_size, n_heads, seq_length, n_ctxs * topk)
             scores = scores[:, :, :, -kl:] + position_bias[:, :, :, -kl:]  # (batch_size, n_heads, seq_length, key_length)
@@ -1135,13 +1661,65 @@ class MemTransAttn(object):
             # (batch_size, n_heads, seq_length, n_ctxs * topk + key_length)
             attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
             attn_weights = nn.functional.dropout(attn_weights, p=ori_attn.dropout, training=ori_attn.training)
+            attn_output = torch.matmul(attn_weights, value_states)  # (batch_size, n_heads, seq_length, dim_per_head)
             
             # compute output
-            attn_output = self.unshape(torch.matmul(attn_weights, value_states))  # (batch_size, seq_length, dim)
+            attn_output = self.unshape(attn_output)  # (batch_size, seq_length, dim)
             attn_output = ori_attn.o(attn_output)
 
         return attn_weights, attn_output
 
+# shape/project of T5Attention.forward at module level (instead of closures) so that they are traced once
+def t5_shape(attn: T5Attention, states: torch.FloatTensor) -> torch.FloatTensor:
+    """projection"""
+    return states.view(states.size(0), -1, attn.n_heads, attn.key_value_proj_dim).transpose(1, 2)
+
+def append_to_kv_buffer(
+    buffers: Dict[str, torch.FloatTensor], 
+    name: str, 
+    past: torch.FloatTensor,  # (batch_size, n_heads, past_length, dim_per_head)
+    new: torch.FloatTensor,  # (batch_size, n_heads, seq_length, dim_per_head)
+) -> torch.FloatTensor:  # (batch_size, n_heads, past_length + seq_length, dim_per_head)
+    # the returned cache is a prefix view of a buffer with spare capacity, so when generate hands it back
+    # at the next step the new states are written in place instead of reallocating the whole cache
+    buffer = buffers.get(name)
+    pl, length = past.size(2), past.size(2) + new.size(2)
+    reuse = buffer is not None and past.data_ptr() == buffer.data_ptr() and past.stride() == buffer.stride() and \
+        past.shape[:2] == buffer.shape[:2] and past.dtype == new.dtype == buffer.dtype and length <= buffer.size(2)
+    if not reuse:  # first step, reordered cache (beam search), or out of capacity: grow geometrically
+        bs, nh, _, d = past.size()
+        buffer = torch.empty(bs, nh, max(2 * length, 64), d, dtype=new.dtype, device=new.device)
+        buffer[:, :, :pl].copy_(past)
+        buffers[name] = buffer
+    buffer[:, :, pl:length].copy_(new)
+    return buffer[:, :, :length]
+
+def t5_project(
+    attn: T5Attention, 
+    hidden_states: torch.FloatTensor, 
+    proj_layer: nn.Linear, 
+    key_value_states: torch.FloatTensor, 
+    past_key_value: torch.FloatTensor) -> torch.FloatTensor:
+    """projects hidden states correctly to key/query states"""
+    if key_value_states is None:
+        # self-attn
+        # (batch_size, n_heads, seq_length, dim_per_head)
+        hidden_states = t5_shape(attn, proj_layer(hidden_states))
+    elif past_key_value is None:
+        # cross-attn
+        # (batch_size, n_heads, seq_length, dim_per_head)
+        hidden_states = t5_shape(attn, proj_layer(key_value_states))
+
+    if past_key_value is not None:
+        if key_value_states is None:
+            # self-attn
+            # (batch_size, n_heads, key_length, dim_per_head)
+            hidden_states = torch.cat([past_key_value, hidden_states], dim=2)
+        else:
+            # cross-attn
+            hidden_states = past_key_value
+    return hidden_states
+
 def t5attetnion_forward(
         self,
         hidden_states,
@@ -1172,45 +1750,25 @@ def t5attetnion_forward(
 
     key_length = real_seq_length if key_value_states is None else key_value_states.shape[1]
 
-    def shape(states):
-        """projection"""
-        return states.view(batch_size, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
-
-    def unshape(states):
-        """reshape"""
-        return states.transpose(1, 2).contiguous().view(batch_size, -1, self.inner_dim)
-
-    def project(hidden_states, proj_layer, key_value_states, past_key_value):
-        """projects hidden states correctly to key/query states"""
-        if key_value_states is None:
-            # self-attn
-            # (batch_size, n_heads, seq_length, dim_per_head)
-            hidden_states = shape(proj_layer(hidden_states))
-        elif past_key_value is None:
-            # cross-attn
-            # (batch_size, n_heads, seq_length, dim_per_head)
-            hidden_states = shape(proj_layer(key_value_states))
-
+    if key_value_states is None:  # self-attn: project query/key/value states with a single gemm
+        # (batch_size, n_heads, seq_length, dim_per_head) * 3
+        query_states, key_states, value_states = (t5_shape(self, states) for states in 
+            nn.functional.linear(hidden_states, self.mta.get_qkv_weight(self)).chunk(3, dim=-1))
         if past_key_value is not None:
-            if key_value_states is None:
-                # self-attn
-                # (batch_size, n_heads, key_length, dim_per_head)
-                hidden_states = torch.cat([past_key_value, hidden_states], dim=2)
-            else:
-                # cross-attn
-                hidden_states = past_key_value
-        return hidden_states
-
-    # get query states
-    query_states = shape(self.q(hidden_states))  # (batch_size, n_heads, seq_length, dim_per_head)
-
-    # get key/value states
-    key_states = project(
-        hidden_states, self.k, key_value_states, past_key_value[0] if past_key_value is not None else None
-    )
-    value_states = project(
-        hidden_states, self.v, key_value_states, past_key_value[1] if past_key_value is not None else None
-    )
+            # (batch_size, n_heads, key_length, dim_per_head) * 2
+            key_states = append_to_kv_buffer(self.mta.kv_buffers, 'key', past_key_value[0], key_states)
+            value_states = append_to_kv_buffer(self.mta.kv_buffers, 'value', past_key_value[1], value_states)
+    else:
+        # get query states
+        query_states = t5_shape(self, self.q(hidden_states))  # (batch_size, n_heads, seq_length, dim_per_head)
+
+        # get key/value states
+        key_states = t5_project(
+            self, hidden_states, self.k, key_value_states, past_key_value[0] if past_key_value is not None else None
+        )
+        value_states = t5_project(
+            self, hidden_states, self.v, key_value_states, past_key_value[1] if past_key_value is not None else None
+        )
 
     if self.mta.stage == 'save':
         self.mta.save(key_states, value_states)
@@ -1219,15 +1777,23 @@ def t5attetnion_forward(
             position_bias, mask, layer_head_mask, 
             real_seq_length=real_seq_length, key_length=key_length)
     elif self.mta.stage == 'retrieve':
+        if self.mta.mtac is not None:  # the mask is added to the scores (as part of the bias) so it has to be float
+            mask = self.mta.mtac.get_float_mask(mask, dtype=query_states.dtype)
         ret_ks, ret_vs = self.mta.retrieve(query_states, key_length=key_length)
-        if position_bias is None:  # init position_bias in the first layer which is reused in following layers
-            position_bias = self.mta.init_position_bias(
-                self, past_key_value, mask, 
-                real_seq_length=real_seq_length, key_length=key_length, seq_length=seq_length, device=query_states.device)
-        attn_weights, attn_output = self.mta.attn(
-            self, query_states, key_states, value_states, ret_ks, ret_vs, 
-            mask, layer_head_mask, 
-            real_seq_length=real_seq_length, key_length=key_length)
+        if ret_ks.size(-2) == 0:  # nothing retrieved (skipped step or eval) so the original attention is equivalent
+            attn_weights, attn_output, position_bias = self.mta.original_attn(
+                self, query_states, key_states, value_states, past_key_value,
+                position_bias, mask, layer_head_mask, 
+                real_seq_length=real_seq_length, key_length=key_length)
+        else:
+            if position_bias is None:  # init position_bias in the first layer which is reused in following layers
+                position_bias = self.mta.init_position_bias(
+                    self, past_key_value, mask, 
+                    real_seq_length=real_seq_length, key_length=key_length, seq_length=seq_length, device=query_states.device)
+            attn_weights, attn_output = self.mta.attn(
+                self, query_states, key_states, value_states, ret_ks, ret_vs, 
+                mask, layer_head_mask, 
+                real_seq_length=real_seq_length, key_length=key_length, output_attentions=output_attentions)
     else:  # original code
         attn_weights, attn_output, position_bias = self.mta.original_attn(
             self, query_states, key_states, value_states, past_key_value,
@@ -1242,6 +1808,12 @@ def t5attetnion_forward(
     return outputs
 
 
+class MemTransT5Attention(T5Attention):
+    # installed by swapping __class__ of existing layers (instead of rebinding forward on the instance)
+    # so that the patched layers stay regular modules for dynamo tracing
+    forward = t5attetnion_forward
+
+
 class MemTransWrapper(object):
     def __init__(
         self, 
@@ -1268,6 +1840,13 @@ class MemTransWrapper(object):
         num_ctxs: int = 1,
         ctx_order: str = 'parallel',
         move_dstore_to_mem: bool = False, 
+        use_torch_search: bool = False,
+        dstore_precision: str = 'fp32',
+        index_type: str = 'flat',
+        nprobe: int = 32,
+        target_recall: float = None,  # tune nprobe of ivfpq indices to reach this recall@k instead of using nprobe
+        token_dtype: str = 'int32',
+        compile: bool = False,  # torch.compile the retrieval-augmented attention computation
         device: torch.device = None):
         self.dstore_size = dstore_size
         self.dstore_dir = dstore_dir
@@ -1292,6 +1871,13 @@ class MemTransWrapper(object):
         self.num_ctxs = num_ctxs
         self.ctx_order = ctx_order
         self.move_dstore_to_mem = move_dstore_to_mem
+        self.use_torch_search = use_torch_search
+        self.dstore_precision = dstore_precision
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.target_recall = target_recall
+        self.token_dtype = token_dtype
+        self.compile = compile
         self.device = torch.device('cpu') if device is None else device
     
     def get_layer(self, key: str = 'memtrans'):
@@ -1316,16 +1902,18 @@ class MemTransWrapper(object):
         model.decoder.forward = self.pre_decoder_forward_hook
         
         attn_layers = self.get_layer()
-        self.ori_t5attetnion_forwards = []
+        self.ori_attn_classes = []
         self.dstores = []
-        mtac = MemTransAttnCoordinator()
+        self.mtac = mtac = MemTransAttnCoordinator()
         for li, (layer_idx, attn_layer) in enumerate(attn_layers):
             # replace the attention layer with retrieval-augmented attention layer
-            self.ori_t5attetnion_forwards.append(attn_layer.forward)
-            attn_layer.forward = types.MethodType(t5attetnion_forward, attn_layer)
+            self.ori_attn_classes.append(attn_layer.__class__)
+            attn_layer.__class__ = MemTransT5Attention
 
             # load dstore (and index if in retrieval stage)
             dstore_device = self.device
+            # the query of a layer depends on the output of the previous one so searches can't be batched across layers;
+            # with cache_indices the first layer searches once per step and the others only gather with its indices
             if self.cache_indices and li > 0:  # load index to CPU except for the first one
                 dstore_device = torch.device('cpu')
             dstore = MemTransDatastore(
@@ -1335,9 +1923,16 @@ class MemTransWrapper(object):
                 dimension=self.model.config.d_kv,
                 n_heads=self.model.config.num_heads,
                 move_dstore_to_mem=self.move_dstore_to_mem,
+                use_torch_search=self.use_torch_search,
+                precision=self.dstore_precision,
+                index_type=self.index_type,
+                nprobe=self.nprobe,
+                token_dtype=self.token_dtype,
                 device=dstore_device)
             if self.stage == 'retrieve':
                 dstore.load_index(build_offset=True)
+                if self.target_recall and self.index_type == 'ivfpq' and not (self.cache_indices and li > 0):
+                    dstore.tune_nprobe(self.target_recall, topk=self.k)
             self.dstores.append(dstore)
             
             # inject MemTransAttn
@@ -1364,26 +1959,29 @@ class MemTransWrapper(object):
                 mtac=mtac,
                 num_ctxs=self.num_ctxs,
                 ctx_order=self.ctx_order)
+            if self.compile and self.stage == 'retrieve':
+                # only the pure tensor part: retrieval itself calls faiss/numpy and would break the graph
+                mta.attn = torch.compile(mta.attn, dynamic=True)
+            if self.cache_indices:
+                mtac.register(mta)
             attn_layer.mta = mta
             attn_layer.relative_attention_bias = relative_attention_bias
 
     def pre_forward_hook(self, input_ids=None, attention_mask=None, labels=None, **kwargs):
         decoder_input_ids = self.model.prepare_decoder_input_ids_from_labels(labels) if labels is not None else None
-        for dstore in self.dstores:
-            dstore.save_labels(labels, decoder_input_ids)
+        self.mtac.save_labels(labels, decoder_input_ids)  # shared by all layers
         return self.original_forward_func(input_ids=input_ids, labels=labels, attention_mask=attention_mask, **kwargs)
     
     def pre_decoder_forward_hook(self, input_ids=None, **kwargs):
-        for dstore in self.dstores:
-            dstore.save_decoder_input_ids(input_ids)
+        self.mtac.save_decoder_input_ids(input_ids)  # shared by all layers
         return self.original_decoder_forward_func(input_ids=input_ids, **kwargs)
 
     def break_out(self):
         if self.model is not None and self.model.broken_into is not None:
             self.model.forward = self.original_forward_func
             attn_layers = self.get_layer()
-            for (layer_idx, attn_layer), ori_fwd in zip(attn_layers, self.ori_t5attetnion_forwards):
-                attn_layer.forward = ori_fwd
+            for (layer_idx, attn_layer), ori_cls in zip(attn_layers, self.ori_attn_classes):
+                attn_layer.__class__ = ori_cls
                 #attn_layer.mta.dump_save_for_accumlation('test')  # TODO: add argument
                 attn_layer.mta.dump_retrieval('test')  # TODO: add argument
                 del attn_layer.mta
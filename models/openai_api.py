@@ -9,22 +9,28 @@ import os
 import re
 import time
 import json
+try:
+    import orjson  # faster parsing and encoding of jsonl lines
+    json_loads = orjson.loads
+    json_dumps_line = lambda obj: orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    json_loads = json.loads
+    json_dumps_line = lambda obj: (json.dumps(obj) + '\n').encode('utf-8')
+import asyncio
 import copy
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoTokenizer, GPT2TokenizerFast
 from datasets import load_dataset, Dataset
-from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.search.lexical import BM25Search
-import openai
-from .retriever import BM25
 from .templates import CtxPrompt, RetrievalInstruction
-from .cohere_api import cohere_generate
-from .ai21_api import ai21_generate
+# openai, beir and the retriever (elasticsearch, torch) are imported where they are used to keep importing this module cheap
 
 logging.basicConfig(level=logging.INFO)
 
 
 class ApiReturn:
-    EOS = '<|endoftext|>'
+    EOS = '<|endoftext|>'  # only shows up in the tokens (requested with logprobs), not in the text
 
     def __init__(
         self,
@@ -43,16 +49,38 @@ class ApiReturn:
         return self.EOS in self.tokens
 
 
+class RateLimiter:
+    # token bucket of max_num_req_per_min requests refilled continuously
+    def __init__(self, max_num_req_per_min: int):
+        self.capacity = max_num_req_per_min
+        self.rate = max_num_req_per_min / 60  # tokens per second
+        self.tokens = float(self.capacity)
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1  # reserve before awaiting so concurrent callers queue up behind each other
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
 class QueryAgent:
     def __init__(
         self,
         model: str = 'code-davinci-002',
         max_generation_len: int = 128,
         retrieval_kwargs: Dict[str, Any] = {},
-        tokenizer: AutoTokenizer = None
+        tokenizer: AutoTokenizer = None,
+        max_num_req_per_min: int = 10,
+        max_concurrency: int = None,  # max number of requests in flight (default to max_num_req_per_min)
     ):
         self.model = model
         self.tokenizer = tokenizer
+        self.max_num_req_per_min = max_num_req_per_min
+        self.max_concurrency = max_concurrency or max_num_req_per_min
+        self.max_prompts_per_req = 20  # prompts sent in one completion request
 
         # generation args
         self.final_stop_sym = 'Question:'
@@ -73,9 +101,15 @@ class QueryAgent:
         self.look_ahead_boundary = retrieval_kwargs.get('look_ahead_boundary', 0)
         self.max_query_length = retrieval_kwargs.get('max_query_length', None)
         self.only_use_look_ahead = retrieval_kwargs.get('only_use_look_ahead', False)
+        # skip the look ahead of examples whose question alone already retrieves a doc with at least this bm25 score
+        self.look_ahead_skip_score = retrieval_kwargs.get('look_ahead_skip_score', None)
         self.retrieval_trigers = retrieval_kwargs.get('retrieval_trigers', [])
         for rts, rte in self.retrieval_trigers:
             assert rte in self.ret_boundary, 'end of retrieval trigers must be used as boundary'
+        self.retrieval_triger_res: List[re.Pattern] = [re.compile(rts) for rts, rte in self.retrieval_trigers]  # compiled starts
+        # all starts in one alternation (group t{i} is the i-th triger) so a single pass finds the first triger of any kind
+        self.retrieval_triger_re: re.Pattern = re.compile(
+            '|'.join(f'(?P<t{i}>{rts})' for i, (rts, rte) in enumerate(self.retrieval_trigers))) if self.retrieval_trigers else None
         self.use_gold_iterative = retrieval_kwargs.get('use_gold_iterative', False)
         self.append_retrieval = retrieval_kwargs.get('append_retrieval', False)
 
@@ -86,6 +120,15 @@ class QueryAgent:
             self.ret_frequency = self.max_generation_len
             self.ret_boundary = []
 
+        self.rate_limiters: Dict[int, RateLimiter] = {}  # max_num_req_per_min -> limiter shared across calls
+        # greedy decoding is deterministic so identical requests (e.g., look ahead of the same prompt) are answered from an lru cache
+        self.cache_size = 10000
+        self.cache: OrderedDict[str, ApiReturn] = OrderedDict()
+
+    @staticmethod
+    def cache_key(query: str, params: Dict[str, Any]) -> str:
+        return hashlib.sha1((query + '\0' + json.dumps(params, sort_keys=True)).encode('utf-8')).hexdigest()
+
     @property
     def use_retrieval(self):
         return self.ret_frequency > 0 or self.ret_boundary or self.use_gold
@@ -101,41 +144,135 @@ class QueryAgent:
         self,
         queries: List[str],
         params: Dict[str, Any],
-        max_num_req_per_min: int = 10,
+        max_num_req_per_min: int = None,
         debug: bool = False,
+        watch: List[str] = None,  # stream and stop reading once any of these shows up (stops the server doesn't know about)
     ) -> List[ApiReturn]:
         if 'max_tokens' in params:  # TODO: opt doesn't have this bug
             params['max_tokens'] = max(2, params['max_tokens'])  # openai returns nothing if set to 1
-        min_sleep = 60 / max_num_req_per_min
+        if not ('davinci' in self.model or 'opt' in self.model):
+            raise NotImplementedError
+        # batched requests are issued concurrently so a batch costs about one round-trip
+        generations = asyncio.run(self.acomplete(queries, params, max_num_req_per_min=max_num_req_per_min, watch=watch))
+        if debug:
+            print(queries[0])
+            print('-->', generations[0].text)
+            input()
+        return generations
+
+    async def acomplete(
+        self,
+        queries: List[str],
+        params: Dict[str, Any],
+        max_num_req_per_min: int = None,
+        watch: List[str] = None,
+    ) -> List[ApiReturn]:
+        max_num_req_per_min = max_num_req_per_min or self.max_num_req_per_min
+        if max_num_req_per_min not in self.rate_limiters:
+            self.rate_limiters[max_num_req_per_min] = RateLimiter(max_num_req_per_min)
+        limiter = self.rate_limiters[max_num_req_per_min]
+        semaphore = asyncio.Semaphore(self.max_concurrency)  # created here since it binds to the running loop
+
+        # only send prompts that are neither cached nor duplicated in this batch
+        # (with greedy decoding this covers what n > 1 over a shared prompt would give: the same generation)
+        keys = [self.cache_key(q, {**params, 'watch': watch} if watch else params) for q in queries]
+        to_send: Dict[str, str] = {}
+        for k, q in zip(keys, queries):
+            if k in self.cache:
+                self.cache.move_to_end(k)
+            elif k not in to_send:
+                to_send[k] = q
+        if to_send:
+            # unique prompts go out as one batched request (per max_prompts_per_req) so a batch uses one request of the rate limit
+            prompts = list(to_send.values())
+            chunks = [prompts[i:i + self.max_prompts_per_req] for i in range(0, len(prompts), self.max_prompts_per_req)]
+            rets = await asyncio.gather(*[self.acomplete_batch(c, params, limiter, semaphore, watch=watch) for c in chunks])
+            for k, ret in zip(to_send, [ret for chunk_rets in rets for ret in chunk_rets]):
+                self.cache[k] = ret
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        # copy since callers modify the returns in place
+        return [copy.copy(self.cache[k]) for k in keys]
+
+    async def acomplete_batch(
+        self,
+        queries: List[str],
+        params: Dict[str, Any],
+        limiter: RateLimiter,
+        semaphore: asyncio.Semaphore,
+        watch: List[str] = None,
+    ) -> List[ApiReturn]:
+        import openai
         add_sleep = 3
         expbf = 1.5
-        while True:
-            if 'davinci' in self.model or 'opt' in self.model:
+        async with semaphore:
+            while True:
+                await limiter.acquire()
                 try:
-                    responses = openai.Completion.create(
+                    if watch:
+                        return await self.astream_batch(queries, params, watch)
+                    response = await openai.Completion.acreate(
                         model=self.model,
                         prompt=queries,
                         temperature=self.temperature,
                         top_p=self.top_p,
-                        logprobs=0,
                         **params)
-                    generations = [ApiReturn(
+                    choices = sorted(response['choices'], key=lambda r: r['index'])  # one choice per prompt
+                    return [ApiReturn(
                         prompt=q,
                         text=r['text'],
-                        tokens=r['logprobs']['tokens'],
-                        finish_reason=r['finish_reason']) for r, q in zip(responses['choices'], queries)]
-                    if debug:
-                        print(queries[0])
-                        print('-->', generations[0].text)
-                        input()
-                    break
-                except openai.error.RateLimitError or openai.error.ServiceUnavailableError or openai.error.APIError or openai.error.Timeout:
-                    logging.info(f'sleep {add_sleep + min_sleep}')
-                    time.sleep(add_sleep + min_sleep)
+                        tokens=r['logprobs']['tokens'] if r.get('logprobs') else [],
+                        finish_reason=r['finish_reason']) for r, q in zip(choices, queries)]
+                except (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError, openai.error.Timeout):
+                    logging.info(f'sleep {add_sleep}')
+                    await asyncio.sleep(add_sleep)
                     add_sleep = add_sleep * expbf
-        if 'davinci' in self.model:
-            time.sleep(min_sleep)
-        return generations
+
+    async def astream_batch(
+        self,
+        queries: List[str],
+        params: Dict[str, Any],
+        watch: List[str],
+    ) -> List[ApiReturn]:
+        # read the generations as they stream (chunks of all prompts are interleaved and carry the prompt index)
+        # and close the stream as soon as every prompt has a watched symbol or has finished
+        # so the server does not keep generating tokens that would be cut off anyway
+        import openai
+        response = await openai.Completion.acreate(
+            model=self.model,
+            prompt=queries,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            stream=True,
+            **params)
+        texts: List[List[str]] = [[] for _ in queries]
+        tokens: List[List[str]] = [[] for _ in queries]
+        finish_reasons: List[str] = [None] * len(queries)
+        tails: List[str] = [''] * len(queries)  # symbols can span chunks so keep the end of what was seen before
+        keep = max(map(len, watch)) - 1
+        num_done = 0
+        try:
+            async for chunk in response:
+                for r in chunk['choices']:
+                    i = r['index']
+                    if finish_reasons[i] is not None:  # already cut off
+                        continue
+                    texts[i].append(r['text'])
+                    tokens[i].extend(r['logprobs']['tokens'] if r.get('logprobs') else [])
+                    tail = tails[i] + r['text']
+                    if any(w in tail for w in watch):
+                        finish_reasons[i] = 'stop'
+                    else:
+                        finish_reasons[i] = r.get('finish_reason')
+                    tails[i] = tail[-keep:] if keep else ''
+                    num_done += finish_reasons[i] is not None
+                if num_done == len(queries):
+                    break
+        finally:
+            if hasattr(response, 'aclose'):
+                await response.aclose()
+        return [ApiReturn(prompt=q, text=''.join(t), tokens=tk, finish_reason=fr or 'stop')
+            for q, t, tk, fr in zip(queries, texts, tokens, finish_reasons)]
 
     def prompt(
         self,
@@ -165,43 +302,58 @@ class QueryAgent:
     ):
         batch_size = len(queries)
         final_retrievals: List[List[List[str]]] = [[] for _ in range(len(queries))]  # (bs, n_ret_steps, ret_topk)
-        final_outputs: List[str] = [''] * len(queries)
+        final_outputs: List[List[str]] = [[] for _ in range(len(queries))]  # chunks joined at the end
         traces: List[List[Tuple[str, str]]] = [[] for _ in range(len(queries))]
-        queries: List[Tuple[int, CtxPrompt]] = [(i, q) for i, q in enumerate(queries)]  # to query
+        prompts: List[CtxPrompt] = queries
+        alive = np.ones(batch_size, dtype=bool)  # examples that still need to be queried
         max_gen_len = 0
 
-        generate_queries: List[str] = []
-        while len(queries) and max_gen_len < self.max_generation_len:
+        generate_queries: List[str] = []  # aligned with the active examples
+        while alive.any() and max_gen_len < self.max_generation_len:
+            active: List[int] = np.flatnonzero(alive).tolist()
             # retrieve
-            look_aheads: List[str] = [''] * len(queries)
-            if self.look_ahead_steps:  # generate a fixed number tokens for retrieval
+            # the look ahead cannot share a request with the generation below since the latter is
+            # prompted with the ctx retrieved using the look ahead (requests within a call are already concurrent)
+            look_aheads: List[str] = [''] * len(active)
+            look_ahead_idxs: List[int] = list(range(len(active)))  # positions in active that need a look ahead
+            if (self.look_ahead_steps or self.look_ahead_boundary) and not generate_queries and \
+                self.look_ahead_skip_score is not None and not self.only_use_look_ahead:
+                # a cheap (cached) bm25 probe with the question alone decides whether the look ahead is worth a request
+                scores = self.retriever.top_scores([prompts[i].question for i in active], max_query_length=self.max_query_length)
+                look_ahead_idxs = [_i for _i, score in enumerate(scores) if score < self.look_ahead_skip_score]
+            if look_ahead_idxs and self.look_ahead_steps:  # generate a fixed number tokens for retrieval
                 apireturns = self.complete(
-                    [q.format(use_ctx=True) for i, q in queries],
-                    params={'max_tokens': self.look_ahead, 'stop': self.final_stop_sym})
-                look_aheads = [ar.text for ar in apireturns]
-            elif self.look_ahead_boundary:  # generate tokens until boundary for retrieval
+                    [prompts[active[_i]].format(use_ctx=True) for _i in look_ahead_idxs],
+                    params={'max_tokens': self.look_ahead_steps, 'stop': self.final_stop_sym})
+                for _i, ar in zip(look_ahead_idxs, apireturns):
+                    look_aheads[_i] = ar.text
+            elif look_ahead_idxs and self.look_ahead_boundary:  # generate tokens until boundary for retrieval
                 apireturns = self.complete(
-                    [q.format(use_ctx=True) for i, q in queries],
+                    [prompts[active[_i]].format(use_ctx=True) for _i in look_ahead_idxs],
                     params={'max_tokens': self.max_generation_len, 'stop': self.look_ahead_boundary})
-                look_aheads = [ar.text for ar in apireturns]
-            assert len(look_aheads) == len(queries)
+                for _i, ar in zip(look_ahead_idxs, apireturns):
+                    look_aheads[_i] = ar.text
+            assert len(look_aheads) == len(active)
 
             # send queries to index
             if generate_queries:  # some queries might be None which means no queries are generated
-                assert len(generate_queries) == len(queries)
+                assert len(generate_queries) == len(active)
                 queries_to_issue = [gq for gq in generate_queries if gq]
             else:
                 # TODO: only use question
-                queries_to_issue = [lh if self.only_use_look_ahead else (q.case.split('\n')[0].split(':', 1)[1].strip() + lh)
-                    for (i, q), lh in zip(queries, look_aheads)]
+                queries_to_issue = [lh if self.only_use_look_ahead else (prompts[i].question + lh)
+                    for i, lh in zip(active, look_aheads)]
             if queries_to_issue:
                 # (bs, ret_topk) * 2
                 ctx_ids, ctx_texts = self.retriever.retrieve_and_prepare(
                     decoder_texts=queries_to_issue,
                     topk=self.ret_topk,
                     max_query_length=self.max_query_length)
+                # convert the whole batch once instead of per example
+                ctx_ids, ctx_texts = ctx_ids.tolist(), list(map(' '.join, ctx_texts))
                 idx = -1
-                for _i, (i, q) in enumerate(queries):
+                for _i, i in enumerate(active):
+                    q = prompts[i]
                     if generate_queries:
                         if generate_queries[_i]:
                             idx += 1
@@ -209,7 +361,7 @@ class QueryAgent:
                                 ret_id, ret_text = q.change_ctx()
                                 ret_id = [ret_id]
                             else:
-                                ret_id, ret_text = ctx_ids[idx].tolist(), ' '.join(ctx_texts[idx])
+                                ret_id, ret_text = ctx_ids[idx], ctx_texts[idx]
                             final_retrievals[i].append(ret_id)
                             if self.append_retrieval:
                                 q.ctx = None
@@ -217,7 +369,7 @@ class QueryAgent:
                             else:
                                 q.update_retrieval(ret_text)
                     else:
-                        ret_id, ret_text = ctx_ids[_i].tolist(), ' '.join(ctx_texts[_i])
+                        ret_id, ret_text = ctx_ids[_i], ctx_texts[_i]
                         if self.append_retrieval:
                             final_retrievals[i].append(ret_id)
                             q.ctx = None
@@ -230,15 +382,16 @@ class QueryAgent:
             # complete
             if self.ret_frequency:
                 apireturns = self.complete(
-                    [q.format(use_ctx=True) for i, q in queries],
+                    [prompts[i].format(use_ctx=True) for i in active],
                     params={'max_tokens': self.ret_frequency, 'stop': self.final_stop_sym})
                 max_gen_len += self.ret_frequency
             elif self.ret_boundary:
                 apireturns = self.complete(
-                    [q.format(use_ctx=True) for i, q in queries],
-                    params={'max_tokens': self.max_generation_len - max_gen_len, 'stop': self.ret_boundary})
+                    [prompts[i].format(use_ctx=True) for i in active],
+                    # tokens (logprobs) are only requested here since has_endoftext needs them
+                    params={'max_tokens': self.max_generation_len - max_gen_len, 'stop': self.ret_boundary, 'logprobs': 0},
+                    watch=[self.final_stop_sym])  # the continuation is cut at final_stop_sym below
                 # used to collect the generation with ret_boundary
-                min_cont_len = 100000
                 for i, ar in enumerate(apireturns):
                     cont, reason = ar.text, ar.finish_reason
                     if ar.has_endoftext:  # 003 stops proactively by returning endoftext
@@ -246,10 +399,8 @@ class QueryAgent:
                             generate_queries.append(None)
                     elif reason == 'stop' and self.final_stop_sym not in cont:  # stop at ret_boundary
                         if self.retrieval_trigers:  # extract queries from generation
-                            assert len(self.retrieval_trigers) == 1
-                            # TODO: check if it stops at retrieval trigers
-                            ret_tri_start = self.retrieval_trigers[0][0]
-                            found = re.search(ret_tri_start, cont)
+                            # TODO: check if it stops at retrieval trigers (found.lastgroup tells which one)
+                            found = self.retrieval_triger_re.search(cont)
                             if found:
                                 generate_queries.append(cont[found.span()[1]:].strip())
                             else:
@@ -261,43 +412,44 @@ class QueryAgent:
                     else:
                         if self.retrieval_trigers:
                             generate_queries.append(None)
-                    if self.final_stop_sym in cont:
-                        cont = cont.split(self.final_stop_sym, 1)[0]
+                    stop_at = cont.find(self.final_stop_sym)  # single scan for both the check and the cut
+                    if stop_at >= 0:
+                        cont = cont[:stop_at]
                         reason = 'stop'
                     apireturns[i].text = cont
                     apireturns[i].finish_reason = reason
-                    min_cont_len = min(min_cont_len, len(self.tokenizer.tokenize(cont)))
-                max_gen_len += min_cont_len
+                # only the length is needed so encode all generations in one call to the fast tokenizer
+                cont_ids = self.tokenizer([ar.text for ar in apireturns], add_special_tokens=False)['input_ids']
+                max_gen_len += min(map(len, cont_ids)) if cont_ids else 100000
             else:
                 raise NotImplementedError
 
             # decide whether to continue
-            new_queries = []
             new_generate_queries = []
-            assert len(queries) == len(apireturns)
+            assert len(active) == len(apireturns)
             if self.retrieval_trigers:
-                assert len(queries) == len(generate_queries), f'{len(queries)} {len(generate_queries)}'
-            for _i, ((i, query), ar) in enumerate(zip(queries, apireturns)):
+                assert len(active) == len(generate_queries), f'{len(active)} {len(generate_queries)}'
+            for _i, (i, ar) in enumerate(zip(active, apireturns)):
                 cont, reason = ar.text, ar.finish_reason
-                final_outputs[i] += cont
+                final_outputs[i].append(cont)
                 traces[i].append((ar.prompt, cont))
                 if reason == 'stop':
-                    pass
+                    alive[i] = False
                 elif reason in {'length', 'boundary'}:
-                    query.case += cont
-                    new_queries.append((i, query))
+                    prompts[i].append_case(cont)
                     if self.retrieval_trigers:
                         new_generate_queries.append(generate_queries[_i])
                 else:
                     raise ValueError
-            queries = new_queries
             generate_queries = new_generate_queries
+        final_outputs: List[str] = [''.join(chunks) for chunks in final_outputs]
         return final_outputs, final_retrievals, traces
 
 class BaseDataset:
     def format(
         self,
         fewshot: int = 0,
+        num_proc: int = None,
     ):
         def _format(
             example: Dict,
@@ -320,14 +472,19 @@ class BaseDataset:
             'ctx': ' '.join(map(itemgetter(1), self.examplars[i]['ctxs'])) if 'ctxs' in self.examplars[i] and self.examplars[i]['ctxs'] else None,
         } for i in range(fewshot)] if fewshot else []
 
-        def _format_for_dataset(example):
+        # the demo is the same for all examples so it is kept once instead of in every row
+        self.demo = demo
+
+        def _format_for_dataset(examples: Dict[str, List]):
+            n = len(examples['question'])
             # case
-            case = _format(example, use_answer=False, input_template_func=self.test_input_template)
-            # ctx
-            example['demo'] = demo
-            example['case'] = case
-            return example
-        self.dataset = self.dataset.map(_format_for_dataset)
+            examples['case'] = [
+                _format({k: v[i] for k, v in examples.items()}, use_answer=False, input_template_func=self.test_input_template) 
+                for i in range(n)]
+            return examples
+        num_proc = max(1, (os.cpu_count() or 1) // 2) if num_proc is None else num_proc
+        num_proc = min(num_proc, max(1, len(self.dataset) // 1000))  # not worth a worker for less than a batch
+        self.dataset = self.dataset.map(_format_for_dataset, batched=True, batch_size=1000, num_proc=num_proc if num_proc > 1 else None)
 
     def retrieval_augment_examplars(
         self,
@@ -336,16 +493,19 @@ class BaseDataset:
         add_index: bool = False,
         use_gold: bool = False,
     ):
+        # collect the queries of all examplars first and retrieve them in one batch
+        # retrievals are kept as (query index, reference index) placeholders until then
+        queries: List[str] = []
+        new_cots: List[List[Any]] = []
         for examplar in self.examplars:
             question = examplar['question']
             cot = examplar['cot']
-            new_cot: List[str] = []
+            new_cot: List[Any] = []
             assert type(cot) is not str
 
             # search question
-            ctx_ids, ctx_texts = qagent.retrieve([question])
-            ctx_ids, ctx_texts = ctx_ids[0], ctx_texts[0]  # (ret_topk) * 2
-            new_cot.append(CtxPrompt.get_append_retrieval(' '.join(ctx_texts), index=0 if add_index else None))
+            queries.append(question)
+            new_cot.append((len(queries) - 1, 0 if add_index else None))
 
             # search cot
             ind = 1
@@ -354,9 +514,9 @@ class BaseDataset:
                 query = None
                 if not retrieval_at_beginning:
                     if qagent.retrieval_trigers:
-                        for rts, rte in qagent.retrieval_trigers:
-                            if re.search(rts, t) and t.endswith(rte):
-                                query = re.sub(rts, '', t).strip()
+                        for rts_re, (rts, rte) in zip(qagent.retrieval_triger_res, qagent.retrieval_trigers):
+                            if rts_re.search(t) and t.endswith(rte):
+                                query = rts_re.sub('', t).strip()
                                 break
                     else:
                         query = t.strip()
@@ -374,17 +534,20 @@ class BaseDataset:
                         assert qagent.ret_topk == 1
                         ctx_texts = [examplar['ctxs'][ctx_ind][1]]
                         ctx_ind += 1
+                        new_cot.append(CtxPrompt.get_append_retrieval(' '.join(ctx_texts), index=ind if add_index else None))
                     else:
-                        # (1, ret_topk) * 2
-                        ctx_ids, ctx_texts = qagent.retrieve([query])
-                        # (ret_topk) * 2
-                        ctx_ids, ctx_texts = ctx_ids[0], ctx_texts[0]
-                    new_cot.append(CtxPrompt.get_append_retrieval(' '.join(ctx_texts), index=ind if add_index else None))
+                        queries.append(query)
+                        new_cot.append((len(queries) - 1, ind if add_index else None))
                 else:
                     prefix = f'Thought {ind}: ' if add_index else ''
                     new_cot.append(prefix + t)
                     ind += 1
-            examplar['cot'] = new_cot
+            new_cots.append(new_cot)
+
+        # (n_queries, ret_topk) * 2
+        ctx_ids, ctx_texts = qagent.retrieve(queries)
+        for examplar, new_cot in zip(self.examplars, new_cots):
+            examplar['cot'] = [c if type(c) is str else CtxPrompt.get_append_retrieval(' '.join(ctx_texts[c[0]]), index=c[1]) for c in new_cot]
             examplar['ctxs'] = []
 
 class StrategyQA(BaseDataset):
@@ -542,11 +705,12 @@ class StrategyQA(BaseDataset):
 
     def load_data(self, beir_dir: str):
         query_file = os.path.join(beir_dir, 'queries.jsonl')
+        from beir.datasets.data_loader import GenericDataLoader
         corpus, queries, qrels = GenericDataLoader(data_folder=beir_dir).load(split='dev')
-        dataset = []
-        with open(query_file, 'r') as fin:
+        dataset: Dict[str, List] = {k: [] for k in ['qid', 'question', 'cot', 'answer', 'gold_output', 'ctxs']}  # columns
+        with open(query_file, 'rb') as fin:
             for l in fin:
-                example = json.loads(l)
+                example = json_loads(l)
                 qid = example['_id']
                 question = example['text']
                 cot = example['metadata']['cot']
@@ -554,15 +718,9 @@ class StrategyQA(BaseDataset):
                 rel_dids = [did for did, rel in qrels[qid].items() if rel]
                 ctxs = [(did, corpus[did]['text']) for did in rel_dids]
                 output = self.output_template(cot, ans)
-                dataset.append({
-                    'qid': qid,
-                    'question': question,
-                    'cot': cot,
-                    'answer': ans,
-                    'gold_output': output,
-                    'ctxs': ctxs,
-                })
-        return Dataset.from_list(dataset)
+                for k, v in zip(['qid', 'question', 'cot', 'answer', 'gold_output', 'ctxs'], [qid, question, cot, ans, output, ctxs]):
+                    dataset[k].append(v)
+        return Dataset.from_dict(dataset)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -578,6 +736,9 @@ if __name__ == '__main__':
     parser.add_argument('--max_num_examples', type=int, default=None)
     parser.add_argument('--fewshot', type=int, default=6)
     parser.add_argument('--max_generation_len', type=int, default=128)
+    parser.add_argument('--max_num_req_per_min', type=int, default=10, help='rate limit of api requests')
+    parser.add_argument('--max_concurrency', type=int, default=None, help='max number of api requests in flight')
+    parser.add_argument('--bucket_by_length', action='store_true', help='batch prompts of similar length together')
 
     parser.add_argument('--build_index', action='store_true')
     parser.add_argument('--seed', type=int, default=2022)
@@ -587,6 +748,9 @@ if __name__ == '__main__':
 
     # load retrieval corpus and index
     index_name = 'test'
+    from beir.datasets.data_loader import GenericDataLoader
+    from beir.retrieval.search.lexical import BM25Search
+    from .retriever import BM25
     corpus, queries, qrels = GenericDataLoader(data_folder=args.input).load(split='dev')
     if args.build_index:
         BM25Search(index_name=index_name, hostname='localhost', initialize=True, number_of_shards=1).index(corpus)
@@ -619,6 +783,7 @@ if __name__ == '__main__':
         'look_ahead_steps': 0,
         'look_ahead_boundary': [],
         'only_use_look_ahead': False,
+        'look_ahead_skip_score': None,
         'retrieval_trigers': [],
         'append_retrieval': False,
         'use_retrieval_instruction': True
@@ -627,7 +792,9 @@ if __name__ == '__main__':
         model=args.model,
         tokenizer=prompt_tokenizer,
         max_generation_len=args.max_generation_len,
-        retrieval_kwargs=retrieval_kwargs)
+        retrieval_kwargs=retrieval_kwargs,
+        max_num_req_per_min=args.max_num_req_per_min,
+        max_concurrency=args.max_concurrency)
     if retrieval_kwargs['use_retrieval_instruction']:
         CtxPrompt.ret_instruction = RetrievalInstruction()
 
@@ -639,12 +806,13 @@ if __name__ == '__main__':
         data.format(fewshot=args.fewshot)
     else:
         raise NotImplementedError
+    demo = [CtxPrompt.from_dict(d) for d in data.demo]  # shared by all prompts
     data = data.dataset
 
     # downsample
     if args.max_num_examples and args.max_num_examples < len(data):
-        data = data.shuffle()
-        data = data.select(range(args.max_num_examples))
+        # sample the indices directly instead of permuting the whole dataset, sorted for contiguous reads
+        data = data.select(sorted(random.sample(range(len(data)), args.max_num_examples)))
     if args.num_shards > 1:
         shard_size = int(np.ceil(len(data) / args.num_shards))
         data_from = args.shard_id * shard_size
@@ -653,20 +821,42 @@ if __name__ == '__main__':
     logging.info(f'#examples {len(data)}, shard {args.shard_id} / {args.num_shards}')
     logging.info(f'first example: {data[0]}')
 
+    # bucket by length so prompts in a batch take similar time (the output is written back in the original order)
+    order: np.ndarray = None
+    if args.bucket_by_length:
+        order = np.argsort([len(case) for case in data['case']], kind='stable')
+        data = data.select(order.tolist())
+
     # query
     if os.path.dirname(args.output):
         os.makedirs(os.path.dirname(args.output), exist_ok=True)
 
-    with tqdm(total=len(data)) as pbar, open(args.output, 'w') as fout:
-        for b in range(0, len(data), args.batch_size):
-            batch = data.select(range(b, min(b + args.batch_size, len(data))))
-            prompts = [CtxPrompt.from_dict(example) for example in batch]
+    def prepare_batch(b: int) -> Tuple[List[Dict], List[CtxPrompt]]:
+        # a slice reads the columns directly instead of building a new indices mapping per batch
+        columns = data[b:b + args.batch_size]
+        batch = [dict(zip(columns, values)) for values in zip(*columns.values())]
+        return batch, [CtxPrompt.from_dict(example, demo=demo) for example in batch]
+
+    # prepare the next batch in the background while the current one waits on the api
+    with tqdm(total=len(data)) as pbar, open(args.output, 'wb', buffering=1 << 20) as fout, ThreadPoolExecutor(max_workers=1) as prefetcher:
+        starts = list(range(0, len(data), args.batch_size))
+        next_batch = prefetcher.submit(prepare_batch, starts[0]) if starts else None
+        for bi in range(len(starts)):
+            batch, prompts = next_batch.result()
+            if bi + 1 < len(starts):
+                next_batch = prefetcher.submit(prepare_batch, starts[bi + 1])
             generations, retrievals, traces = qagent.prompt(prompts)
             retrievals = retrievals or [None] * len(generations)
             traces = traces or [None] * len(generations)
-            for example, generation, retrieval, trace in zip(batch, generations, retrievals, traces):
-                example['output'] = generation
-                example['retrieval'] = retrieval
-                example['trace'] = trace
-                fout.write(json.dumps(example) + '\n')
+            fout.writelines([json_dumps_line({**example, 'output': generation, 'retrieval': retrieval, 'trace': trace})
+                for example, generation, retrieval, trace in zip(batch, generations, retrievals, traces)])  # one write per batch
             pbar.update(len(batch))
+
+    if order is not None:  # line j of the output is example order[j]
+        with open(args.output, 'rb') as fin:
+            lines = fin.readlines()
+        ori_lines: List[bytes] = [None] * len(lines)
+        for j, line in zip(order.tolist(), lines):
+            ori_lines[j] = line
+        with open(args.output, 'wb') as fout:
+            fout.writelines(ori_lines)
@@ -1,4 +1,5 @@
-from typing import List, Callable
+from typing import List, Callable, Tuple
+from collections import OrderedDict
 import time
 import numpy as np
 import torch
@@ -18,6 +19,7 @@ class BM25:
         encode_retrieval_in: str = 'encoder',
         use_encoder_input_ids: bool = False,
         use_decoder_input_ids: bool = True,
+        cache_size: int = 100000,
     ):
         self.tokenizer = tokenizer
         self.collator = collator
@@ -30,6 +32,52 @@ class BM25:
         self.use_encoder_input_ids = use_encoder_input_ids
         self.use_decoder_input_ids = use_decoder_input_ids
         assert use_encoder_input_ids or use_decoder_input_ids, 'nothing used as queries'
+        # lru cache of (query, topk) -> (docids, scores) so repeated queries do not go to elasticsearch again
+        self.cache_size = cache_size
+        self.cache: OrderedDict[Tuple[str, int], Tuple[List[str], List[float]]] = OrderedDict()
+
+    def truncate_queries(self, queries: List[str], max_query_length: int = None) -> List[str]:
+        if not max_query_length:
+            return queries
+        ori_ps = self.tokenizer.padding_side
+        ori_ts = self.tokenizer.truncation_side
+        self.tokenizer.padding_side = 'left'
+        self.tokenizer.truncation_side = 'left'
+        tokenized = self.tokenizer(
+            queries,
+            truncation=True,
+            padding=True,
+            max_length=max_query_length,
+            add_special_tokens=False,
+            return_tensors='pt')['input_ids']
+        self.tokenizer.padding_side = ori_ps
+        self.tokenizer.truncation_side = ori_ts
+        return self.tokenizer.batch_decode(tokenized, skip_special_tokens=True)
+
+    def search(self, queries: List[str], topk: int) -> List[Tuple[List[str], List[float]]]:
+        # ranked (docids, scores) per query, only queries that are neither cached nor duplicated go to elasticsearch
+        keys = [(q, topk) for q in queries]
+        misses = list(dict.fromkeys(k for k in keys if k not in self.cache))
+        if misses:
+            # the elasticsearch client already keeps pooled keep-alive connections across calls, what is left per call is
+            # the size of the response: only ask for topk hits (the default of EvaluateRetrieval is 1000 per query)
+            self.retriever.top_k = topk
+            self.retriever.retriever.results = {}  # accumulated across calls by BM25Search which could leak stale results
+            results = self.retriever.retrieve(self.corpus, dict(zip(range(len(misses)), [q for q, _ in misses])), disable_tqdm=True)
+            for qid, key in enumerate(misses):
+                ranked = list(results[qid].items())[:topk] if qid in results else []
+                self.cache[key] = ([did for did, _ in ranked], [score for _, score in ranked])
+        ranked: List[Tuple[List[str], List[float]]] = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            ranked.append(self.cache[key])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return ranked
+
+    def top_scores(self, queries: List[str], max_query_length: int = None) -> List[float]:
+        # bm25 score of the best doc per query (0 if nothing matches), a cheap confidence of retrieving with the query alone
+        return [scores[0] if scores else 0.0 for _, scores in self.search(self.truncate_queries(queries, max_query_length), topk=1)]
 
     def retrieve_and_prepare(
         self,
@@ -89,30 +137,16 @@ class BM25:
                     queries = list(decoder_texts)
 
             # truncate queries
-            if max_query_length:
-                ori_ps = self.tokenizer.padding_side
-                ori_ts = self.tokenizer.truncation_side
-                self.tokenizer.padding_side = 'left'
-                self.tokenizer.truncation_side = 'left'
-                tokenized = self.tokenizer(
-                    queries,
-                    truncation=True,
-                    padding=True,
-                    max_length=max_query_length,
-                    add_special_tokens=False,
-                    return_tensors='pt')['input_ids']
-                self.tokenizer.padding_side = ori_ps
-                self.tokenizer.truncation_side = ori_ts
-                queries = self.tokenizer.batch_decode(tokenized, skip_special_tokens=True)
+            queries = self.truncate_queries(queries, max_query_length)
 
             # retrieve
-            results = self.retriever.retrieve(self.corpus, dict(zip(range(len(queries)), queries)), disable_tqdm=True)
+            ranked = self.search(queries, topk)
 
             # prepare outputs
             docids: List[str] = []
             docs: List[str] = []
-            for qid, query in enumerate(queries):
-                _docids: List[str] = list(results[qid].keys())[:topk] if qid in results else []
+            for _docids, _ in ranked:
+                _docids = list(_docids)
                 _docs = [self.corpus[did]['text'] for did in _docids]
                 if len(_docids) < topk:  # add dummy docs
                     _docids += ['-1'] * (topk - len(_docids))
@@ -2,6 +2,8 @@ from typing import List, Dict, Any, Tuple
 
 
 class CtxPrompt:
+    # 'before_case' keeps everything before the retrieval byte-identical across iterative retrieval steps,
+    # so the shared prefix (instructions and demos) can hit the prefix cache of the serving backend
     ctx_position: str = 'begin'
     ret_instruction: "RetrievalInstruction" = None
 
@@ -22,6 +24,34 @@ class CtxPrompt:
         self.case = case
         self.qid = qid
         self.ind = 0
+        self._demo_formatted: str = None  # demos never change so they are only formatted once
+        self._question: str = None
+
+    @property
+    def case(self) -> str:
+        # kept as appended parts and joined lazily (once per change) instead of copying the whole case on every append
+        if len(self._case_parts) > 1:
+            self._case_parts = [''.join(self._case_parts)]
+        return self._case_parts[0] if self._case_parts else None
+
+    @case.setter
+    def case(self, case: str):
+        self._case_parts: List[str] = [] if case is None else [case]
+
+    def append_case(self, cont: str):
+        self._case_parts.append(cont)
+
+    @property
+    def question(self) -> str:
+        # what follows the first ':' in the first line of the case, which only grows after that line
+        if self._question is not None:
+            return self._question
+        nl = self.case.find('\n')
+        first = self.case if nl < 0 else self.case[:nl]
+        question = first[first.index(':') + 1:].strip()
+        if nl >= 0:  # the first line is complete so it will not change
+            self._question = question
+        return question
 
     @staticmethod
     def get_append_retrieval(ret_to_append: str, index: int = None):
@@ -30,9 +60,11 @@ class CtxPrompt:
         return f'Reference: {ret_to_append}\n'
 
     @classmethod
-    def from_dict(cls, adict):
+    def from_dict(cls, adict, demo: List["CtxPrompt"] = None):
         adict = dict(adict)
-        if 'demo' in adict:
+        if demo is not None:  # demo already built (and shared)
+            adict['demo'] = demo
+        elif 'demo' in adict:
             adict['demo'] = [cls.from_dict(d) for d in adict['demo']]
         return cls(**{k: adict[k] for k in ['demo', 'ctx', 'ctxs', 'case', 'qid'] if k in adict})
 
@@ -45,7 +77,7 @@ class CtxPrompt:
         return self.did, self.ctx
 
     def append_retrieval(self, ret_to_append: str, add_index: bool = False):
-        self.case += self.get_append_retrieval(ret_to_append, index=self.ind if add_index else None)
+        self.append_case(self.get_append_retrieval(ret_to_append, index=self.ind if add_index else None))
         self.ind = (self.ind + 1) if add_index else self.ind
 
     def update_retrieval(self, ret: str, dedup: bool = True):
@@ -58,6 +90,11 @@ class CtxPrompt:
             else:
                 self.ctx += ' ' + ret
 
+    def format_demo(self) -> str:
+        if self._demo_formatted is None:
+            self._demo_formatted = '\n\n'.join([d.format(use_ctx=False, use_ret_instruction=False) for d in self.demo])  # TODO: no retrieval for demo
+        return self._demo_formatted
+
     def format(
         self,
         use_ctx: bool = False,
@@ -67,7 +104,7 @@ class CtxPrompt:
             self.ctx = ' '.join([ctx for _, ctx in self.ctxs])
         use_ret_instruction = use_ret_instruction and self.ret_instruction is not None
 
-        demo_formatted: str = '\n\n'.join([d.format(use_ctx=False, use_ret_instruction=False) for d in self.demo])  # TODO: no retrieval for demo
+        demo_formatted: str = self.format_demo()
         ref = ('Reference:\n' + self.ctx) if use_ctx else None
         task, ret, ensemble = self.ret_instruction.format() if use_ret_instruction else (None, None, None)
         elements: List[str] = []
@@ -3,11 +3,20 @@ import argparse
 import random
 import os
 import json
+try:
+    import orjson  # faster encoding/decoding of jsonl lines
+    json_loads = orjson.loads
+    json_dumps_line = lambda obj: orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    json_loads = json.loads
+    json_dumps_line = lambda obj: (json.dumps(obj) + '\n').encode('utf-8')
 import time
 import glob
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import csv
 import copy
+import functools
+from multiprocessing import Pool
 import evaluate
 import re
 from tqdm import tqdm
@@ -20,33 +29,87 @@ from beir.retrieval.evaluation import EvaluateRetrieval
 from beir.retrieval.search.lexical import BM25Search as BM25
 
 class Wikipedia(object):
-    def __init__(self):
+    def __init__(self, cache_size: int = 10000):
         from kilt.knowledge_source import KnowledgeSource
         self.ks = KnowledgeSource()
+        # lru cache of wiki_id -> page since the same pages are cited many times
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, Dict] = OrderedDict()
+
+    def prefetch(self, wiki_ids: List[str]):
+        # fetch all pages not in the cache with a single query instead of one round-trip per page
+        missing = [wid for wid in dict.fromkeys(map(str, wiki_ids)) if wid not in self.cache]
+        if not missing:
+            return
+        if hasattr(self.ks, 'db'):  # the mongo collection behind get_page_by_id
+            pages = {page['_id']: page for page in self.ks.db.find({'_id': {'$in': missing}})}
+        else:
+            pages = {wid: self.ks.get_page_by_id(wid) for wid in missing}
+        for wid in missing:
+            if wid in pages:
+                self.cache[wid] = pages[wid]
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get_page(self, wiki_id: str) -> Dict:
+        wiki_id = str(wiki_id)
+        if wiki_id not in self.cache:
+            self.cache[wiki_id] = self.ks.get_page_by_id(wiki_id)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache.move_to_end(wiki_id)
+        return self.cache[wiki_id]
 
     def get_provenance(self, wiki_id: str, ps: int, pe: int, cs: int, ce: int, whole_paragraph: bool = False) -> str:
-        page = self.ks.get_page_by_id(wiki_id)
-        prov: List[str] = []
+        text: List[str] = self.get_page(wiki_id)['text']
         if ps == pe:  # only one paragraph
-            if whole_paragraph:
-                prov.append(page['text'][ps])
-            else:
-                prov.append(page['text'][ps][cs:ce])
-        else:
-            for pi in range(ps, pe + 1):
-                if pi == ps:
-                    if whole_paragraph:
-                        prov.append(page['text'][pi])
-                    else:
-                        prov.append(page['text'][pi][cs:])
-                elif pi == pe:
-                    if whole_paragraph:
-                        prov.append(page['text'][pi])
-                    else:
-                        prov.append(page['text'][pi][:ce])
-                else:
-                    prov.append(page['text'][pi])
-        return ' '.join(prov)
+            return text[ps] if whole_paragraph else text[ps][cs:ce]
+        if ps > pe:
+            return ''
+        head = text[ps] if whole_paragraph else text[ps][cs:]
+        tail = text[pe] if whole_paragraph else text[pe][:ce]
+        return ' '.join((head, *text[ps + 1:pe], tail))
+
+_wikipedia: Wikipedia = None  # one per (worker) process
+
+def _init_kilt_worker():
+    global _wikipedia
+    if _wikipedia is None:
+        _wikipedia = Wikipedia()
+
+def format_kilt_example(
+    example: Dict,
+    evidence_method: str = 'provenance',
+    whole_paragraph_as_evidence: bool = False,
+    skip_answer_as_evidence: bool = True) -> Tuple[str, List[str], str]:
+    wikipedia = _wikipedia
+    inp: str = example['input']
+    answer: str = None
+    evidences: List[str] = []
+    if 'provenance' in evidence_method:
+        wikipedia.prefetch([prov['wikipedia_id'] for ans_or_provs in example['output'] for prov in ans_or_provs['provenance']])
+
+    # collect
+    for ans_or_provs in example['output']:
+        ans = ans_or_provs['answer'].strip()
+        provs = ans_or_provs['provenance']
+
+        this_is_ans = False
+        if ans and answer is None:  # use the first answer as the qa pair
+            this_is_ans = True
+            answer = ans
+        if 'self' in evidence_method or not skip_answer_as_evidence or not this_is_ans:  # whether use the real answer
+            if 'provenance' in evidence_method and len(provs):  # collect all provenance
+                for prov in provs:
+                    wiki_id = prov['wikipedia_id']
+                    ps, pe, cs, ce = prov['start_paragraph_id'], prov['end_paragraph_id'], prov['start_character'], prov['end_character']
+                    #prov = prov['meta']['evidence_span'][-1].split('\r')[0]
+                    prov = wikipedia.get_provenance(wiki_id, ps, pe, cs, ce, whole_paragraph=whole_paragraph_as_evidence)  # always use the whole paragraph
+                    evidences.append(prov.strip())
+            if 'answer' in evidence_method and ans:
+                evidences.append(ans)
+    evidences = list(dict.fromkeys(evidences))  # the same paragraph is often the provenance of several answers
+    return inp, evidences, answer
 
 def prep_kilt(
     output_file: str,
@@ -58,43 +121,26 @@ def prep_kilt(
     remove_wo_ctx: bool = True,
     num_negative_evidence: int = 0,
     subsample: int = 0,
-    output_format: str = 'translation'):
+    output_format: str = 'translation',
+    num_workers: int = 1):
     assert dataset_name in {'eli5', 'wow'}
     assert evidence_method in {'provenance', 'self_provenance', 'answer', 'self_answer'}
     assert output_format in {'translation', 'dpr'}
 
     data = load_dataset('kilt_tasks', name=dataset_name)
-    wikipedia = Wikipedia()
-
-    formatteds: List[Tuple] = []
-    for i, example in tqdm(enumerate(data[split]), desc='format data'):
-        inp: str = example['input']
-        answer: str = None
-        evidences: List[str] = []
-
-        # collect
-        for ans_or_provs in example['output']:
-            ans = ans_or_provs['answer'].strip()
-            provs = ans_or_provs['provenance']
-
-            this_is_ans = False
-            if ans and answer is None:  # use the first answer as the qa pair
-                this_is_ans = True
-                answer = ans
-            if 'self' in evidence_method or not skip_answer_as_evidence or not this_is_ans:  # whether use the real answer
-                if 'provenance' in evidence_method and len(provs):  # collect all provenance
-                    for prov in provs:
-                        wiki_id = prov['wikipedia_id']
-                        ps, pe, cs, ce = prov['start_paragraph_id'], prov['end_paragraph_id'], prov['start_character'], prov['end_character']
-                        #prov = prov['meta']['evidence_span'][-1].split('\r')[0]
-                        prov = wikipedia.get_provenance(wiki_id, ps, pe, cs, ce, whole_paragraph=whole_paragraph_as_evidence)  # always use the whole paragraph
-                        evidences.append(prov.strip())
-                if 'answer' in evidence_method and ans:
-                    evidences.append(ans)
-
-        if len(evidences) <= 0 and remove_wo_ctx:  # remove examples without ctx
-            continue
-        formatteds.append((inp, evidences, answer))
+
+    format_func = functools.partial(
+        format_kilt_example, 
+        evidence_method=evidence_method, 
+        whole_paragraph_as_evidence=whole_paragraph_as_evidence, 
+        skip_answer_as_evidence=skip_answer_as_evidence)
+    if num_workers > 1:  # examples are independent, each worker has its own connection to the knowledge source
+        with Pool(num_workers, initializer=_init_kilt_worker) as pool:
+            formatteds: List[Tuple] = list(tqdm(pool.imap(format_func, data[split], chunksize=64), desc='format data'))  # keep the order
+    else:
+        _init_kilt_worker()
+        formatteds: List[Tuple] = [format_func(example) for example in tqdm(data[split], desc='format data')]
+    formatteds = [f for f in formatteds if len(f[1]) > 0 or not remove_wo_ctx]  # remove examples without ctx
 
     print(f'#examples {len(formatteds)}')
 
@@ -132,18 +178,16 @@ def prep_kilt(
             prov_file = f'{output_file}_evidence.json'
             inds = range(len(formatteds))
 
-        with open(qa_file, 'w') as qfin, open(prov_file, 'w') as pfin:
+        with open(qa_file, 'wb', buffering=1 << 20) as qfin, open(prov_file, 'wb', buffering=1 << 20) as pfin:
             for ind in inds:
                 inp, evidences, answer = formatteds[ind]
                 # write qa pairs
-                qfin.write(json.dumps({'translation': {'en': inp, 'zh': answer}}) + '\n')
-                # write evidences
+                qfin.write(json_dumps_line({'translation': {'en': inp, 'zh': answer}}))
+                # write evidences (all of an example at once)
                 if 'self' in evidence_method:
-                    for evi in evidences:
-                        pfin.write(json.dumps({'translation': {'en': inp, 'zh': answer, 'decoder_prefix': evi}}) + '\n')
+                    pfin.writelines([json_dumps_line({'translation': {'en': inp, 'zh': answer, 'decoder_prefix': evi}}) for evi in evidences])
                 else:
-                    for evi in evidences:
-                        pfin.write(json.dumps({'translation': {'en': inp, 'zh': evi}}) + '\n')
+                    pfin.writelines([json_dumps_line({'translation': {'en': inp, 'zh': evi}}) for evi in evidences])
 
     elif output_format == 'dpr':
         assert num_negative_evidence, 'dpr format requires negative evidence'
@@ -170,70 +214,117 @@ class PredictionWithRetrieval(object):
         self.topk = topk
         self.tokenizer = tokenizer
         self.use_tokenizer = use_tokenizer
-        self.tokens: List[List] = []
+        self.lines: List[str] = []  # raw lines, parsed in one go when first needed
+        self._parsed: Tuple[np.ndarray, np.ndarray, np.ndarray] = None  # (preds, head_tokens, head_ids)
 
     def convert_token_id(self, token_id: int) -> Union[str, int]:
-        if self.use_tokenizer:
+        if self.use_tokenizer and self.tokenizer is not None:
             return self.tokenizer.convert_ids_to_tokens([token_id])[0]
         else:
             return token_id
 
     def add_one_word(self, line: str):
-        seq = line.strip().split(' ')
-        token: List = []  # [pred_token, head1, head2, ..., headn]
-        self.tokens.append(token)
-        token.append(self.convert_token_id(int(seq[0])))
-        for i in range(1, len(seq)):
-            t = int(seq[i])
-            i -= 1
-            if i % (self.topk * 2) == 0:  # a new head
-                token.append([])
-            # convert token id to token
-            if i % 2 == 0:  # token
-                token[-1].append(self.convert_token_id(t))
-            else:  # id
-                token[-1][-1] = (token[-1][-1], t)
-        assert len(token) == 1 + self.n_heads
+        # each line is "pred_token (token id) * topk for head1 ... (token id) * topk for headn"
+        self.lines.append(line)
+        self._parsed = None
+
+    def parse(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._parsed is None:
+            # parse all integers in C in one call instead of building a list of python strings
+            arr = np.fromstring(' '.join(self.lines), dtype=np.int64, sep=' ')
+            arr = arr.reshape(len(self.lines), 1 + self.n_heads * self.topk * 2)  # fails if a line has a wrong number of heads
+            heads = arr[:, 1:].reshape(-1, self.n_heads, self.topk, 2)
+            # separate contiguous arrays so that reductions over ids scan memory sequentially
+            # (n_tokens,) (n_tokens, n_heads, topk) (n_tokens, n_heads, topk)
+            self._parsed = (arr[:, 0].copy(), np.ascontiguousarray(heads[..., 0]), np.ascontiguousarray(heads[..., 1]))
+        return self._parsed
+
+    @property
+    def preds(self) -> np.ndarray:  # (n_tokens,)
+        return self.parse()[0]
+
+    @property
+    def head_tokens(self) -> np.ndarray:  # (n_tokens, n_heads, topk)
+        return self.parse()[1]
+
+    @property
+    def head_ids(self) -> np.ndarray:  # (n_tokens, n_heads, topk)
+        return self.parse()[2]
+
+    @property
+    def tokens(self) -> List[List]:  # [pred_token, [(token, id)] * topk for head1, ..., headn] per token
+        return [[self.convert_token_id(pred)] + [[(self.convert_token_id(t), i) for t, i in head] for head in heads]
+            for pred, heads in zip(self.preds.tolist(), np.stack([self.head_tokens, self.head_ids], axis=-1).tolist())]
 
     def get_ids(self, head_idx: int):
-        return np.array([[ret_id for (_, ret_id) in tok[head_idx + 1]] for tok in self.tokens])
+        return self.head_ids[:, head_idx, :]  # (n_tokens, topk)
 
     def get_ids_portion(self, id: int, head_idx: int):
         ids = self.get_ids(head_idx=head_idx)  # (n_tokens, topk)
         return (ids == id).any(axis=1).sum() / ids.shape[0]  # percentage of tokens with retrieval from id
 
-def retrieval_track(args, n_heads: int = 32, topk: int = 4) -> List[PredictionWithRetrieval]:
-    tokenizer = AutoTokenizer.from_pretrained('google/t5-xl-lm-adapt')
+    def get_ids_portion_all_heads(self, id: int) -> np.ndarray:  # (n_heads,)
+        # percentage of tokens with retrieval from id for all heads in one reduction
+        return (self.head_ids == id).any(axis=-1).mean(axis=0)
+
+def retrieval_track(args, n_heads: int = 32, topk: int = 4, use_tokenizer: bool = False) -> List[PredictionWithRetrieval]:
+    tokenizer = AutoTokenizer.from_pretrained('google/t5-xl-lm-adapt') if use_tokenizer else None  # only needed to show tokens
     pwrs: List[PredictionWithRetrieval] = []
-    pwr = PredictionWithRetrieval(n_heads=n_heads, topk=topk, tokenizer=tokenizer, use_tokenizer=False)
+    pwr = PredictionWithRetrieval(n_heads=n_heads, topk=topk, tokenizer=tokenizer, use_tokenizer=use_tokenizer)
     with open(args.inp, 'r') as fin, open(args.inp.replace('.txt', '.tsv'), 'w') as fout:
         tsv_writer = csv.writer(fout, delimiter='\t')
         for l in tqdm(fin):
             if l.strip() == '':
                 pwrs.append(pwr)
-                pwr = PredictionWithRetrieval(n_heads=n_heads, topk=topk, tokenizer=tokenizer, use_tokenizer=False)
+                pwr = PredictionWithRetrieval(n_heads=n_heads, topk=topk, tokenizer=tokenizer, use_tokenizer=use_tokenizer)
                 #tsv_writer.writerow([])
             else:
                 pwr.add_one_word(l)
                 #tsv_writer.writerow(l)
     return pwrs
 
-def shuffle_evidence(inp_file: str, out_file: str):
-    data: List[Dict] = []
-    evis: List[str] = []
-    with open(inp_file, 'r') as fin, open(out_file, 'w') as fout:
-        for l in fin:
-            data.append(json.loads(l))
-            evis.append(data[-1]['translation']['decoder_prefix'])
-        random.shuffle(evis)
-        for example, evi in zip(data, evis):
-            example['translation']['decoder_prefix'] = evi
-            fout.write(json.dumps(example) + '\n')
+def fadvise(f, advice: str):
+    # hint the kernel about the access pattern (no-op where posix_fadvise is unavailable)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, getattr(os, f'POSIX_FADV_{advice}'))
+
+def shuffle_evidence(inp_file: str, out_file: str, buffer_size: int = 8 << 20):
+    # only keep line offsets in memory: the first pass records them, the second pass
+    # reads each example and seeks to the line its evidence comes from
+    offsets: List[int] = []
+    with open(inp_file, 'rb', buffering=buffer_size) as fin:
+        fadvise(fin, 'SEQUENTIAL')
+        pos = fin.tell()
+        for l in iter(fin.readline, b''):
+            offsets.append(pos)
+            pos += len(l)
+    perm = list(range(len(offsets)))
+    random.shuffle(perm)  # same permutation shuffling the evidence list itself would give
+    # large buffers for the sequential streams, the default small one for the random donor reads
+    with open(inp_file, 'rb', buffering=buffer_size) as fin, open(inp_file, 'rb') as fdonor, open(out_file, 'wb', buffering=buffer_size) as fout:
+        fadvise(fin, 'SEQUENTIAL')
+        fadvise(fdonor, 'RANDOM')
+        for l, p in zip(fin, perm):
+            example = json_loads(l)
+            fdonor.seek(offsets[p])
+            example['translation']['decoder_prefix'] = json_loads(fdonor.readline())['translation']['decoder_prefix']
+            fout.write(json_dumps_line(example))
 
 def head_analysis(attn_file: str, rank: bool = True, show_n_heads: int = 5):
-    attensions: torch.FloatTensor = torch.load(attn_file)  # (n_heads, n_examples, n_docs)
-    sorted, indices = torch.sort(attensions, dim=-1, descending=True)  # (n_heads, n_examples, n_docs)
-    top1_acc = indices[:, :, 0].eq(0).float().mean(-1).numpy()  # (n_heads)
+    # (n_heads, n_examples, n_docs) memory-mapped so that only one head is paged in at a time
+    if attn_file.endswith('.npy'):
+        attensions = np.load(attn_file, mmap_mode='r')
+    else:
+        try:
+            attensions: torch.FloatTensor = torch.load(attn_file, mmap=True)
+        except (TypeError, RuntimeError):  # older torch without mmap or a legacy (non-zipfile) checkpoint
+            attensions: torch.FloatTensor = torch.load(attn_file)
+    top1_acc = np.empty(attensions.shape[0], dtype=np.float64)  # (n_heads)
+    for h in range(attensions.shape[0]):  # only the top doc is needed so no full sort
+        head = attensions[h]
+        if isinstance(head, torch.Tensor):  # per head so that dtypes numpy lacks (e.g., bf16) are only upcast one head at a time
+            head = (head.float() if head.dtype == torch.bfloat16 else head).numpy()
+        top1_acc[h] = (np.asarray(head).argmax(-1) == 0).mean()
     rank = np.argsort(-top1_acc)[:show_n_heads]
     print('\t'.join(map(str, rank)))
     print('\t'.join(map(str, top1_acc[rank])))
@@ -956,6 +1047,7 @@ if __name__ == '__main__':
         'strategyqa_to_beir', 'tsv_to_beir', 'eval'])
     parser.add_argument('--inp', type=str, default=None, nargs='+', help='input file')
     parser.add_argument('--out', type=str, default=None, help='output file')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of processes used to format kilt examples')
     args = parser.parse_args()
 
     # set random seed to make sure the same examples are sampled across multiple runs
@@ -972,15 +1064,17 @@ if __name__ == '__main__':
             remove_wo_ctx=True,
             num_negative_evidence=10000,
             subsample=0,
-            output_format='dpr')
+            output_format='dpr',
+            num_workers=args.num_workers)
 
     elif args.task == 'retrieval_track':
         n_heads = 32
         topk = 4
         pwrs = retrieval_track(args, n_heads=n_heads, topk=topk)
         print(f'total number of examples {len(pwrs)}')
+        portion = np.stack([pwr.get_ids_portion_all_heads(i) for i, pwr in enumerate(pwrs)], 0).mean(0)  # (n_heads,)
         for head_idx in range(n_heads):
-            print(head_idx, np.mean([pwr.get_ids_portion(i, head_idx) for i, pwr in enumerate(pwrs)]))
+            print(head_idx, portion[head_idx])
 
     elif args.task == 'head_analysis':
         head_analysis(args.inp[0])